@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+Headless batch mode for the Liberty Bill Uploader
+Processes every workbook and sheet listed in a JSON config, with independent
+workbooks running in parallel worker processes
+
+Example config:
+
+    {
+        "workers": 3,
+        "rate": 2.0,
+        "jobs": [
+            {"workbook": "MWTC UTILITY BILLS - DASHBOARD.xlsm",
+             "sheets": ["COLEVILLE ELECTRICITY"],
+             "date": "2025-03-13"},
+            {"workbook": "OTHER SITE.xlsm",
+             "sheets": {"ELECTRICITY": "Electric", "WATER USE": "Water", "GAS": "Gas"},
+             "date": "2025-01-01", "end_date": "2025-03-31"}
+        ]
+    }
+
+"sheets" is a list of sheet names, whose commodity is taken from the name,
+or an object mapping each sheet to its commodity (Electric, Water or Gas).
+All sheets of a workbook are fetched in one pass over one workbook open.
+"""
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from rate_limiter import AdaptiveRateLimiter, SharedTokenBucket, adaptive_enabled, start_rate
+from sheet_map import DEFAULT_SHEETS, normalize_sheets
+from token_cache import load_token
+
+# Set in each worker process by init_worker
+_limiter = None
+
+def init_worker(bucket):
+    global _limiter
+    # Each worker adapts the shared rate from the responses it sees
+    _limiter = AdaptiveRateLimiter.from_env(bucket) if adaptive_enabled() else bucket
+
+def run_job(job, token, resume=False, force=False):
+    """
+    Process one workbook in a worker process
+
+    Returns:
+        dict: The job with its run summary under 'summary', or its error under 'error'
+    """
+    from simplified_uploader import run_upload
+
+    try:
+        summary = run_upload(token, job['workbook'], job['sheets'], job['date'], job.get('end_date'),
+                             limiter=_limiter, resume=resume, force=force)
+        return dict(job, summary=summary)
+    except Exception as e:
+        print(f"Error processing {job['workbook']}: {e}")
+        return dict(job, error=str(e))
+
+def load_config(path):
+    """
+    Read and validate a batch config
+
+    Returns:
+        dict: The config, with every job's sheets mapped to their commodity
+        (defaulted if missing) and dates checked
+
+    Raises:
+        ValueError: If the config is missing fields, has invalid dates or an
+            unknown commodity
+    """
+    with open(path, 'r') as f:
+        config = json.load(f)
+
+    jobs = config.get('jobs')
+    if not jobs:
+        raise ValueError("Config has no jobs")
+
+    workbooks = set()
+    for job in jobs:
+        if 'workbook' not in job or 'date' not in job:
+            raise ValueError(f"Job needs a workbook and a date: {job}")
+        job['sheets'] = normalize_sheets(job.get('sheets') or DEFAULT_SHEETS)
+        for key in ('date', 'end_date'):
+            if job.get(key):
+                datetime.strptime(job[key], "%Y-%m-%d")
+        # The same workbook can't be opened by two workers at once
+        workbook = os.path.abspath(job['workbook'])
+        if workbook in workbooks:
+            raise ValueError(f"Workbook listed in more than one job: {job['workbook']}")
+        workbooks.add(workbook)
+    return config
+
+def print_summary(results):
+    print("\n===== Batch Summary =====")
+    print(f"{'Workbook':<40} {'Sheet':<25} {'New':>5} {'Skip':>5} {'Err':>5} {'NotDue':>7}")
+    totals = {'new': 0, 'skipped': 0, 'errors': 0, 'not_due': 0}
+    failed = 0
+    for result in results:
+        name = os.path.basename(result['workbook'])
+        if 'error' in result:
+            failed += 1
+            print(f"{name:<40} {'FAILED: ' + result['error']}")
+            continue
+        for sheet_name, sheet_summary in result['summary']['sheets'].items():
+            print(f"{name:<40} {sheet_name:<25} {sheet_summary['new']:>5} "
+                  f"{sheet_summary['skipped']:>5} {sheet_summary['errors']:>5} {sheet_summary['not_due']:>7}")
+            for key in totals:
+                totals[key] += sheet_summary[key]
+    print(f"{'Total':<66} {totals['new']:>5} {totals['skipped']:>5} {totals['errors']:>5} {totals['not_due']:>7}")
+    if failed:
+        print(f"{failed} workbook(s) failed")
+    return failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the Liberty Bill Uploader over several workbooks")
+    parser.add_argument("config", help="JSON file listing the workbooks, sheets and dates to process")
+    parser.add_argument("--workers", type=int, help="Workbooks processed in parallel (default: config or 2)")
+    parser.add_argument("--rate", type=float,
+                        help="Total API requests per second across all workers to start at "
+                             "(default: config, or the rate the last run settled at)")
+    parser.add_argument("--token", help="Bearer token (default: the saved login token)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue interrupted jobs from their checkpoint journals")
+    parser.add_argument("--force", action="store_true",
+                        help="Query every account, even those whose next bill isn't due yet")
+    args = parser.parse_args(argv)
+
+    try:
+        config = load_config(args.config)
+    except (OSError, ValueError) as e:
+        print(f"Error: Invalid config {args.config}: {e}")
+        return 2
+
+    token = args.token or config.get('token')
+    if not token:
+        token, _ = load_token()
+    if not token:
+        print("Error: No valid saved login token. Log in through the GUI first or pass --token.")
+        return 2
+
+    workers = args.workers or config.get('workers', 2)
+    rate = args.rate or config.get('rate') or start_rate()
+    # One bucket for the whole batch, so adding workers doesn't raise the load on the API
+    bucket = SharedTokenBucket(rate, capacity=max(1.0, min(rate, 4.0)))
+
+    jobs = config['jobs']
+    print(f"Processing {len(jobs)} workbook(s) with {workers} worker(s) at {rate} requests/s")
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(bucket,)) as executor:
+        results = list(executor.map(run_job, jobs, [token] * len(jobs), [args.resume] * len(jobs),
+                                    [args.force] * len(jobs)))
+
+    failed = print_summary(results)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
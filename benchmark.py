@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the Liberty Bill Uploader
+Measures the uploader phases against a simulated sheet or a real workbook
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import simplified_uploader
+from fake_liberty_server import FakeLibertyServer, bill_amounts, previous_month, reading_date
+from simplified_uploader import (SheetIndex, check_existing_entry, extract_account_number,
+                                 format_date_for_comparison, get_column_indices, load_sheet_data,
+                                 read_sheet_rows)
+from sheet_map import DEFAULT_SHEETS
+from workbook_backend import SheetBackend, open_workbook
+
+# Sheet generated for each commodity
+COMMODITY_SHEETS = {"Electric": "COLEVILLE ELECTRICITY", "Water": "COLEVILLE WATER", "Gas": "COLEVILLE GAS"}
+
+HEADERS = ["Date", "", "", "Building Name", "", "", "Usage", "Rate ($/kWh))", "Cost ($)", "SQFT"]
+
+class SimulatedSheet(SheetBackend):
+    """In-memory sheet with a fixed latency per round-trip, standing in for Excel over COM"""
+    def __init__(self, rows, latency):
+        super().__init__(None)
+        self.rows = rows
+        self.latency = latency
+        self.round_trips = 0
+
+    def last_row(self):
+        return len(self.rows)
+
+    def read_block(self, first_row, last_row, last_col_idx):
+        self.round_trips += 1
+        time.sleep(self.latency)
+        return [row[:last_col_idx + 1] for row in self.rows[first_row - 1:last_row]]
+
+def make_row(i, account_count=300):
+    """The i-th synthetic dashboard row, for accounts billed every 30 days from 2015"""
+    account = 200000000000 + i % account_count
+    date = datetime(2015, 1, 1) + timedelta(days=30 * (i // account_count))
+    return [date, None, None, f"Building {i % account_count} Account Number: {account}",
+            None, None, 1000.0, 0.12, 120.0, 5000]
+
+def make_rows(row_count, account_count=300):
+    """Build a header row plus row_count dashboard rows spread over account_count accounts"""
+    return [HEADERS] + [make_row(i, account_count) for i in range(row_count)]
+
+class GeneratedSheet(SheetBackend):
+    """Sheet whose rows are created as they are read, like values coming back from Excel"""
+    def __init__(self, row_count, account_count):
+        super().__init__(None)
+        self.row_count = row_count
+        self.account_count = account_count
+
+    def last_row(self):
+        return self.row_count + 1
+
+    def read_block(self, first_row, last_row, last_col_idx):
+        return [(HEADERS if row == 1 else make_row(row - 2, self.account_count))[:last_col_idx + 1]
+                for row in range(first_row, last_row + 1)]
+
+def load_row_dicts(sheet, columns):
+    """
+    The uploader's previous in-memory layout, kept as the memory baseline: a
+    dict per row, account side maps, and an index of (account, date text) tuples
+    """
+    data = []
+    account_to_building = {}
+    account_to_sqft = {}
+    for i, row_data in read_sheet_rows(sheet, 2, sheet.last_row(), max(columns.values())):
+        building_name = row_data[columns['building']]
+        account_number = extract_account_number(building_name)
+        sqft_value = row_data[columns['sqft']]
+        if account_number:
+            account_to_building[account_number] = building_name
+            if sqft_value:
+                account_to_sqft[account_number] = sqft_value
+        data.append({
+            'row': i,
+            'date': row_data[columns['date']],
+            'building_name': building_name,
+            'account_number': account_number,
+            'usage': row_data[columns['usage']],
+            'rate': row_data[columns['rate']],
+            'cost': row_data[columns['cost']],
+            'sqft': sqft_value
+        })
+    entries = set()
+    account_rows = {}
+    last_dates = {}
+    for entry in data:
+        account_number = entry['account_number']
+        if account_number:
+            entries.add((account_number, format_date_for_comparison(entry['date'])))
+            rows = account_rows.setdefault(account_number, [entry['row'], entry['row']])
+            rows[1] = entry['row']
+            if isinstance(entry['date'], datetime):
+                last_dates[account_number] = max(entry['date'], last_dates.get(account_number, entry['date']))
+    return data, account_to_building, account_to_sqft, entries, account_rows, last_dates
+
+def traced_memory(build):
+    """Bytes still allocated by build() once it returns, and its result"""
+    tracemalloc.start()
+    try:
+        result = build()
+        return tracemalloc.get_traced_memory()[0], result
+    finally:
+        tracemalloc.stop()
+
+# Fake API behaviour for the end-to-end scenarios
+SCENARIOS = {
+    "healthy": {"latency": 0.2},
+    "slow": {"latency": 1.0},
+    "flaky": {"latency": 0.2, "error_rate": 0.1},
+    "throttled": {"latency": 0.2, "throttle_rate": 0.2, "retry_after": 0.5},
+    "rate-limited": {"latency": 0.2, "rate_limit": 10, "retry_after": 1.0},
+}
+
+def generate_workbook(path, account_count, history_months, sheets=None, end=None):
+    """
+    Write a dashboard workbook with history_months bills for each of account_count accounts
+
+    Bills use the same reading dates and amounts as fake_liberty_server, so a
+    run against the fake API sees the history as already uploaded.
+
+    Args:
+        sheets (dict): Sheet name to commodity; one sheet per commodity
+            holds every account. sheet_map.DEFAULT_SHEETS if None
+    """
+    import openpyxl
+
+    end = end or datetime.now()
+    months = []
+    year, month = end.year, end.month
+    for _ in range(history_months):
+        year, month = previous_month(year, month)
+        months.append((year, month))
+    months.reverse()
+
+    wb = openpyxl.Workbook()
+    wb.remove(wb.active)
+    for sheet_name, commodity in (sheets or DEFAULT_SHEETS).items():
+        ws = wb.create_sheet(sheet_name)
+        ws.append(HEADERS)
+        for year, month in months:
+            for i in range(account_count):
+                account = 200000000000 + i
+                usage, cost = bill_amounts(account, year, month, commodity)
+                row = ws.max_row + 1
+                ws.append([reading_date(account, year, month), None, None,
+                           f"Building {i} Account Number: {account}", None, None,
+                           usage, cost / usage, cost, 1000 + i])
+                ws.cell(row=row, column=1).number_format = "yyyy-mm-dd"
+                ws.cell(row=row, column=2, value=f"=MONTH(A{row})")
+    wb.save(path)
+
+def bench_e2e(args):
+    """Run the whole uploader against the fake API and a generated workbook"""
+    workdir = tempfile.mkdtemp(prefix="liberty-bench-")
+    try:
+        template = os.path.join(workdir, "template.xlsx")
+        sheets = {COMMODITY_SHEETS[commodity]: commodity for commodity in args.commodities}
+        print(f"Generating workbook: {args.accounts} accounts x {args.history} months x {len(sheets)} sheet(s)...")
+        generate_workbook(template, args.accounts, args.history, sheets)
+
+        os.environ['WORKBOOK_ENGINE'] = "openpyxl"
+        os.environ['USAGE_CACHE'] = "off"
+        os.environ['FETCH_WORKERS'] = str(args.workers)
+        # Start every scenario at --rate and let the adaptive limiter back off from there
+        os.environ['FETCH_RATE'] = str(args.rate)
+        os.environ['FETCH_RATE_MAX'] = str(args.rate)
+
+        os.environ['METRICS_LOG'] = os.path.join(workdir, "metrics.jsonl")
+        # Keep the made-up accounts out of the real usage history
+        os.environ['USAGE_HISTORY'] = os.path.join(workdir, "usage_history.sqlite")
+
+        date_str = datetime.now().strftime("%Y-%m-%d")
+        # Several tokens stand in for several logins; the fake API limits each separately
+        tokens = [f"Bearer benchmark-{i}" for i in range(args.tokens)]
+        print(f"\n{'scenario':<12} {'total s':>8} {'open':>6} {'load':>6} {'fetch':>7} {'write':>6} {'save':>6} "
+              f"{'rows/s':>8} {'calls/s':>8} {'p95 s':>6} {'rate':>6} {'new':>5} {'err':>4}")
+        for name in args.scenarios:
+            path = os.path.join(workdir, f"{name}.xlsx")
+            shutil.copy(template, path)
+            os.environ['RATE_STATE'] = os.path.join(workdir, f"{name}-rate.json")
+            with FakeLibertyServer(**SCENARIOS[name]) as server:
+                os.environ['LIBERTY_API_URL'] = server.url
+                # The uploader's own output is only shown with --verbose
+                output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+                with output:
+                    summary = simplified_uploader.run_upload(tokens, path, sheets, date_str)
+            run = summary['metrics']
+            phases = defaultdict(float, run['phases'])
+            rows = run['counters'].get('sheet_rows', 0)
+            print(f"{name:<12} {run['duration']:>8.2f} {phases['open']:>6.2f} {phases['load']:>6.2f} "
+                  f"{phases['fetch_wait']:>7.2f} {phases['write']:>6.2f} {phases['save']:>6.2f} "
+                  f"{rows / max(phases['load'], 1e-9):>8.0f} {run['api_requests'] / max(phases['fetch_wait'], 1e-9):>8.1f} "
+                  f"{run['api_latency']['p95'] or 0:>6.3f} {summary['fetch_rate']:>6.1f} "
+                  f"{summary['new']:>5} {summary['errors']:>4}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def bench_load(args):
+    print(f"{'rows':>8} {'chunk':>6} {'round-trips':>12} {'seconds':>9} {'rows/s':>10}")
+    for row_count in args.rows:
+        rows = make_rows(row_count)
+        columns = get_column_indices(HEADERS)
+        for chunk_size in args.chunks:
+            sheet = SimulatedSheet(rows, args.latency)
+            start = time.perf_counter()
+            table, _ = load_sheet_data(sheet, columns, chunk_size)
+            elapsed = time.perf_counter() - start
+            print(f"{row_count:>8} {chunk_size:>6} {sheet.round_trips:>12} {elapsed:>9.3f} {len(table) / elapsed:>10.0f}")
+
+def bench_load_workbook(args):
+    wb = open_workbook(args.workbook, args.engine, read_only=args.read_only)
+    try:
+        sheet = wb.sheet(args.sheet)
+        columns = get_column_indices(sheet.read_block(1, 1, 25)[0])
+        for chunk_size in args.chunks:
+            start = time.perf_counter()
+            table, _ = load_sheet_data(sheet, columns, chunk_size)
+            elapsed = time.perf_counter() - start
+            print(f"{len(table)} rows, chunk {chunk_size}: {elapsed:.3f}s")
+    finally:
+        wb.close()
+
+def bench_index(args):
+    print(f"{'rows':>8} {'accounts':>9} {'scan s':>9} {'build s':>9} {'index s':>9} {'speedup':>8}")
+    for row_count in args.rows:
+        rows = make_rows(row_count, args.accounts)
+        columns = get_column_indices(HEADERS)
+        table, _ = load_sheet_data(SimulatedSheet(rows, 0), columns)
+        accounts = sorted(table.account_numbers)
+        data = list(table.records())
+        check_date = datetime(2030, 1, 1)
+
+        # Current approach: duplicate check plus template search, both linear scans
+        start = time.perf_counter()
+        for account_number in accounts:
+            check_existing_entry(data, account_number, check_date)
+            for row in data:
+                if row['account_number'] == account_number:
+                    break
+        scan_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index = SheetIndex.from_table(table)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for account_number in accounts:
+            index.contains(account_number, check_date)
+            index.first_row(account_number)
+        index_time = time.perf_counter() - start
+
+        speedup = scan_time / (build_time + index_time)
+        print(f"{row_count:>8} {len(accounts):>9} {scan_time:>9.3f} {build_time:>9.3f} {index_time:>9.4f} {speedup:>7.0f}x")
+
+def bench_memory(args):
+    print(f"{'rows':>8} {'dicts MB':>9} {'table MB':>9} {'saving':>7} {'dicts s':>8} {'table s':>8}")
+    columns = get_column_indices(HEADERS)
+    for row_count in args.rows:
+        sheet = GeneratedSheet(row_count, args.accounts)
+
+        start = time.perf_counter()
+        dict_bytes, legacy = traced_memory(lambda: load_row_dicts(sheet, columns))
+        dict_time = time.perf_counter() - start
+        del legacy
+
+        def build_table():
+            table, _ = load_sheet_data(sheet, columns)
+            return table, SheetIndex.from_table(table)
+        start = time.perf_counter()
+        table_bytes, _ = traced_memory(build_table)
+        table_time = time.perf_counter() - start
+
+        print(f"{row_count:>8} {dict_bytes / 2**20:>9.1f} {table_bytes / 2**20:>9.1f} "
+              f"{dict_bytes / table_bytes:>6.1f}x {dict_time:>8.2f} {table_time:>8.2f}")
+
+def bench_startup(args):
+    """Time from process start to the GUI window being shown, with -X importtime details"""
+    env = dict(os.environ, STARTUP_BENCHMARK="1")
+    gui = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bill_utility_gui.py")
+    times = []
+    imports = {}
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, "-X", "importtime", gui], env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        for line in proc.stdout:
+            if line.strip() == "window-shown":
+                times.append(time.perf_counter() - start)
+                break
+        _, stderr = proc.communicate()
+        if proc.returncode:
+            print(stderr)
+            return
+
+        # importtime lines: "import time: self [us] | cumulative | imported package"
+        for line in stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            _, cumulative, name = line[len("import time:"):].split("|")
+            if not name.startswith("  "):
+                imports[name.strip()] = int(cumulative)
+
+    times.sort()
+    print(f"time to window over {len(times)} runs: min {times[0]:.3f}s, median {times[len(times) // 2]:.3f}s")
+    print("\nslowest top-level imports (last run, cumulative):")
+    for name, cumulative in sorted(imports.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{cumulative / 1e6:>8.3f}s  {name}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Liberty Bill Uploader benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    load_parser = subparsers.add_parser("load", help="Sheet load time against row count")
+    load_parser.add_argument("--rows", type=int, nargs="+", default=[1000, 5000, 20000])
+    load_parser.add_argument("--chunks", type=int, nargs="+", default=[1, 5000],
+                             help="Rows per range read (1 reproduces the old per-row loop)")
+    load_parser.add_argument("--latency", type=float, default=0.0005,
+                             help="Simulated seconds per COM round-trip")
+    load_parser.add_argument("--workbook", help="Benchmark a real workbook instead")
+    load_parser.add_argument("--sheet", default="COLEVILLE ELECTRICITY")
+    load_parser.add_argument("--engine", choices=["xlwings", "openpyxl"], help="Workbook engine for --workbook")
+    load_parser.add_argument("--read-only", action="store_true", help="Stream the workbook (openpyxl only)")
+
+    index_parser = subparsers.add_parser("index", help="Duplicate check and template lookup: scans vs SheetIndex")
+    index_parser.add_argument("--rows", type=int, nargs="+", default=[5000, 20000, 50000])
+    index_parser.add_argument("--accounts", type=int, default=300)
+
+    memory_parser = subparsers.add_parser("memory", help="Memory held for the sheet rows: per-row dicts vs SheetTable")
+    memory_parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 500000])
+    memory_parser.add_argument("--accounts", type=int, default=300)
+
+    startup_parser = subparsers.add_parser("startup", help="GUI time-to-window and import costs")
+    startup_parser.add_argument("--runs", type=int, default=5)
+    startup_parser.add_argument("--top", type=int, default=10, help="Number of slowest imports to list")
+
+    workbook_parser = subparsers.add_parser("make-workbook", help="Generate a synthetic dashboard workbook")
+    workbook_parser.add_argument("path")
+    workbook_parser.add_argument("--accounts", type=int, default=300)
+    workbook_parser.add_argument("--history", type=int, default=24, help="Months of bills per account")
+    workbook_parser.add_argument("--commodities", nargs="+", choices=sorted(COMMODITY_SHEETS), default=["Electric"],
+                                 help="One sheet per commodity")
+
+    e2e_parser = subparsers.add_parser("e2e", help="End-to-end run against the local fake API")
+    e2e_parser.add_argument("--accounts", type=int, default=100)
+    e2e_parser.add_argument("--history", type=int, default=24, help="Months of bills per account")
+    e2e_parser.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS), default=sorted(SCENARIOS))
+    e2e_parser.add_argument("--workers", type=int, default=8)
+    e2e_parser.add_argument("--rate", type=float, default=50.0, help="Starting (and highest) requests per second")
+    e2e_parser.add_argument("--tokens", type=int, default=1, help="Login tokens to spread requests over")
+    e2e_parser.add_argument("--commodities", nargs="+", choices=sorted(COMMODITY_SHEETS), default=["Electric"],
+                            help="Sheets to fetch in the same run, one per commodity")
+    e2e_parser.add_argument("--verbose", action="store_true", help="Show the uploader's output")
+
+    args = parser.parse_args()
+    if args.command == "make-workbook":
+        generate_workbook(args.path, args.accounts, args.history,
+                          {COMMODITY_SHEETS[commodity]: commodity for commodity in args.commodities})
+    elif args.command == "e2e":
+        bench_e2e(args)
+    elif args.command == "startup":
+        bench_startup(args)
+    elif args.command == "index":
+        bench_index(args)
+    elif args.command == "memory":
+        bench_memory(args)
+    elif args.command == "load":
+        if args.workbook:
+            bench_load_workbook(args)
+        else:
+            bench_load(args)
+
+if __name__ == "__main__":
+    main()
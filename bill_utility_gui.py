@@ -1,21 +1,70 @@
 import sys
 import os
 import json
+import importlib
+import threading
 from datetime import datetime
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                             QHBoxLayout, QPushButton, QLabel, QFileDialog, 
-                            QDateEdit, QMessageBox, QFrame)
-from PyQt5.QtCore import Qt, QDate
+                            QDateEdit, QMessageBox, QFrame, QCheckBox, QProgressBar,
+                            QSpinBox)
+from PyQt5.QtCore import Qt, QDate, QThread, QTimer, pyqtSignal
 from PyQt5.QtGui import QFont, QIcon
-from seleniumbase import SB
-from get_token import extract_token
-from simplified_uploader import main
+from token_cache import load_tokens, profile_name, save_token
+
+# seleniumbase, simplified_uploader and the modules behind it are imported
+# when first needed (or by prewarm_imports once the window is up) so the
+# window shows without waiting for them
+
+def prewarm_imports():
+    """Import the heavy login and upload dependencies in the background"""
+    def load():
+        try:
+            # Imported for their side effect of warming the module cache
+            importlib.import_module("seleniumbase")
+            importlib.import_module("simplified_uploader")
+        except Exception as e:
+            print(f"Background import failed: {e}")
+    threading.Thread(target=load, daemon=True).start()
+
+class UploadWorker(QThread):
+    """Runs simplified_uploader.main off the GUI thread and reports progress"""
+    progress = pyqtSignal(dict)
+    finished_upload = pyqtSignal(object)
+    
+    def __init__(self, tokens):
+        super().__init__()
+        self.tokens = tokens
+        self.cancel_event = threading.Event()
+    
+    def run(self):
+        # xlwings talks to Excel over COM, which must be initialised per thread
+        try:
+            import pythoncom
+            pythoncom.CoInitialize()
+        except ImportError:
+            pythoncom = None
+        summary = None
+        try:
+            from simplified_uploader import main
+            summary = main(self.tokens, progress=self.progress.emit, cancel_event=self.cancel_event)
+        except Exception as e:
+            # upload_finished reports the failure; it must run to re-enable the buttons
+            print(f"Upload failed: {e}")
+        finally:
+            if pythoncom:
+                pythoncom.CoUninitialize()
+        self.finished_upload.emit(summary)
+    
+    def cancel(self):
+        self.cancel_event.set()
 
 class LibertyBillUploader(QMainWindow):
     def __init__(self):
         super().__init__()
-        self.token = None
+        self.tokens = []
         self.file_path = None
+        self.worker = None
         self.init_ui()
         
     def init_ui(self):
@@ -66,6 +115,39 @@ class LibertyBillUploader(QMainWindow):
         date_layout.addWidget(self.date_edit, 1)
         main_layout.addLayout(date_layout)
         
+        # Backfill section: fetch every billing period up to an end date
+        backfill_layout = QHBoxLayout()
+        self.backfill_checkbox = QCheckBox('Backfill to:')
+        self.backfill_checkbox.setToolTip('Add every billing period between the selected date and this end date')
+        self.end_date_edit = QDateEdit(calendarPopup=True)
+        self.end_date_edit.setDate(QDate.currentDate())
+        self.end_date_edit.setDisplayFormat('yyyy-MM-dd')
+        self.end_date_edit.setEnabled(False)
+        self.backfill_checkbox.toggled.connect(self.end_date_edit.setEnabled)
+        backfill_layout.addWidget(self.backfill_checkbox)
+        backfill_layout.addWidget(self.end_date_edit, 1)
+        main_layout.addLayout(backfill_layout)
+        
+        # Resume: replay the checkpoint journal of an interrupted upload
+        self.resume_checkbox = QCheckBox('Resume interrupted upload')
+        self.resume_checkbox.setToolTip('Skip accounts already fetched by the last upload that did not finish')
+        main_layout.addWidget(self.resume_checkbox)
+        
+        # By default accounts whose next bill isn't due yet are not queried
+        self.force_checkbox = QCheckBox('Query all accounts')
+        self.force_checkbox.setToolTip('Also query accounts whose next bill is not due yet going by the dates on the sheet')
+        main_layout.addWidget(self.force_checkbox)
+        
+        # Each login has its own API rate budget; requests are spread over all of them
+        logins_layout = QHBoxLayout()
+        logins_label = QLabel('Logins:')
+        self.logins_spinbox = QSpinBox()
+        self.logins_spinbox.setRange(1, 5)
+        self.logins_spinbox.setToolTip('Number of Liberty accounts to log in with; more logins fetch faster')
+        logins_layout.addWidget(logins_label)
+        logins_layout.addWidget(self.logins_spinbox, 1)
+        main_layout.addLayout(logins_layout)
+        
         # Button section
         button_layout = QHBoxLayout()
         
@@ -80,15 +162,38 @@ class LibertyBillUploader(QMainWindow):
         self.upload_button.clicked.connect(self.upload_bill_data)
         self.upload_button.setEnabled(False)  # Disabled until login is complete
         
+        # Cancel button, only enabled while an upload is running
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.setToolTip('Stops the upload and saves the rows added so far')
+        self.cancel_button.clicked.connect(self.cancel_upload)
+        self.cancel_button.setEnabled(False)
+        
         button_layout.addWidget(self.login_button)
         button_layout.addWidget(self.upload_button)
+        button_layout.addWidget(self.cancel_button)
         main_layout.addLayout(button_layout)
         
+        # Progress section
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setValue(0)
+        main_layout.addWidget(self.progress_bar)
+        self.progress_label = QLabel('')
+        self.progress_label.setAlignment(Qt.AlignCenter)
+        main_layout.addWidget(self.progress_label)
+        
         # Status label
         self.status_label = QLabel('Ready. Please select a file and date, then login.')
         self.status_label.setAlignment(Qt.AlignCenter)
         main_layout.addWidget(self.status_label)
         
+        # Reuse the tokens from the last logins while they are still valid
+        self.tokens = load_tokens()
+        if self.tokens:
+            self.logins_spinbox.setValue(len(self.tokens))
+            self.upload_button.setEnabled(True)
+            self.status_label.setText(
+                f'Using {len(self.tokens)} saved login(s). Select a file and date, then upload.')
+        
         # Show the window
         self.center_on_screen()
         self.show()
@@ -123,36 +228,52 @@ class LibertyBillUploader(QMainWindow):
         self.setEnabled(False)  # Disable the entire UI during login
         
         try:
-            # Setup Chrome data directory
-            full_path = os.path.abspath("chromedatabills")
+            from seleniumbase import SB
+            from get_token import extract_token_from_logs
             
-            # Open browser for login
-            with SB(uc=True, headless=False, user_data_dir=full_path, log_cdp_events=True) as sb:
-                # Open the target website
-                sb.open("https://myaccount.libertyenergyandwater.com/portal/#/login?LUCA")
-                
-                # Show message to user
-                QMessageBox.information(
-                    self, 
-                    'Login Instructions', 
-                    'Please log in to your Liberty account in the browser window.\n\n'
-                    'Once logged in, close this message box to continue.'
-                )
-                
-                # Capture CDP logs after login
-                cdp_logs = sb.driver.get_log("performance")
-                logs_file_path = os.path.abspath("cdp_logs.json")
-                with open(logs_file_path, 'w') as f:
-                    json.dump(cdp_logs, f, indent=4)
+            logins = self.logins_spinbox.value()
+            tokens = []
+            for index in range(logins):
+                # Each login keeps its own Chrome data directory, so its session is separate
+                profile = profile_name(index)
+                full_path = os.path.abspath(profile)
                 
-                # Extract token from logs
-                self.token = extract_token(logs_file_path)
+                # Open browser for login
+                with SB(uc=True, headless=False, user_data_dir=full_path, log_cdp_events=True) as sb:
+                    # Open the target website
+                    sb.open("https://myaccount.libertyenergyandwater.com/portal/#/login?LUCA")
+                    
+                    # Show message to user
+                    account_hint = f' (login {index + 1} of {logins}, use a different account for each)' if logins > 1 else ''
+                    QMessageBox.information(
+                        self, 
+                        'Login Instructions', 
+                        f'Please log in to your Liberty account in the browser window{account_hint}.\n\n'
+                        'Once logged in, close this message box to continue.'
+                    )
+                    
+                    # Capture CDP logs after login
+                    cdp_logs = sb.driver.get_log("performance")
+                    
+                    # Only dump the logs to disk when debugging, they can be tens of MB
+                    if os.environ.get('DEBUG_CDP_LOGS'):
+                        logs_file_path = os.path.abspath("cdp_logs.json")
+                        with open(logs_file_path, 'w') as f:
+                            json.dump(cdp_logs, f, indent=4)
+                    
+                    # Extract token from logs
+                    token = extract_token_from_logs(cdp_logs)
                 
-                if self.token:
-                    self.status_label.setText('Login successful! Token acquired.')
-                    self.upload_button.setEnabled(True)
-                else:
-                    self.status_label.setText('Login failed or token not found. Please try again.')
+                if token and token not in tokens:
+                    save_token(token, profile=profile)
+                    tokens.append(token)
+            
+            if tokens:
+                self.tokens = tokens
+                self.status_label.setText(f'Login successful! {len(tokens)} of {logins} token(s) acquired.')
+                self.upload_button.setEnabled(True)
+            else:
+                self.status_label.setText('Login failed or token not found. Please try again.')
         
         except Exception as e:
             QMessageBox.critical(self, 'Error', f'An error occurred during login: {str(e)}')
@@ -161,35 +282,103 @@ class LibertyBillUploader(QMainWindow):
         self.setEnabled(True)  # Re-enable the UI
     
     def upload_bill_data(self):
-        if not self.token:
+        if not self.tokens:
             QMessageBox.warning(self, 'Warning', 'Please login first to obtain a token.')
             return
+        if not self.file_path:
+            QMessageBox.warning(self, 'Warning', 'Please select an Excel file first.')
+            return
         
-        try:
-            # Get the selected date
-            selected_date = self.date_edit.date().toString('yyyy-MM-dd')
-            
-            # Set environment variables for the main function to use
-            os.environ['SELECTED_DATE'] = selected_date
-            os.environ['EXCEL_FILE'] = self.file_path
-            
-            # Call the main function with the token
+        # Get the selected date
+        selected_date = self.date_edit.date().toString('yyyy-MM-dd')
+        
+        # Set environment variables for the main function to use
+        os.environ['SELECTED_DATE'] = selected_date
+        os.environ['EXCEL_FILE'] = self.file_path
+        if self.backfill_checkbox.isChecked():
+            end_date = self.end_date_edit.date().toString('yyyy-MM-dd')
+            os.environ['END_DATE'] = end_date
+            self.status_label.setText(f'Processing data from {selected_date} to {end_date}...')
+        else:
+            os.environ.pop('END_DATE', None)
             self.status_label.setText(f'Processing data for date: {selected_date}...')
-            
-            # Call the main function with the token
-            main(self.token)
-            
-            self.status_label.setText('Bill data uploaded successfully!')
-            QMessageBox.information(self, 'Success', 'Bill data has been processed and uploaded successfully.')
-            
-        except Exception as e:
-            QMessageBox.critical(self, 'Error', f'An error occurred during upload: {str(e)}')
+        
+        if self.resume_checkbox.isChecked():
+            os.environ['RESUME'] = '1'
+        else:
+            os.environ.pop('RESUME', None)
+        if self.force_checkbox.isChecked():
+            os.environ['FORCE_FETCH'] = '1'
+        else:
+            os.environ.pop('FORCE_FETCH', None)
+        
+        # Run the main function with the tokens on a worker thread so the window stays responsive
+        self.progress_bar.setValue(0)
+        self.progress_label.setText('')
+        self.login_button.setEnabled(False)
+        self.upload_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        
+        self.worker = UploadWorker(self.tokens)
+        self.worker.progress.connect(self.show_progress)
+        self.worker.finished_upload.connect(self.upload_finished)
+        self.worker.start()
+    
+    def show_progress(self, info):
+        self.progress_bar.setMaximum(info['total'])
+        self.progress_bar.setValue(info['done'])
+        minutes, seconds = divmod(int(info['eta']), 60)
+        self.status_label.setText(f"{info['sheet']}: account {info['account']} ({info['done']}/{info['total']})")
+        self.progress_label.setText(
+            f"New: {info['new']}   Skipped: {info['skipped']}   Errors: {info['errors']}   "
+            f"ETA: {minutes}:{seconds:02d}")
+    
+    def cancel_upload(self):
+        if self.worker:
+            self.worker.cancel()
+            self.cancel_button.setEnabled(False)
+            self.status_label.setText('Cancelling, saving the rows added so far...')
+    
+    def upload_finished(self, summary):
+        self.worker = None
+        self.login_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+        # Pick up tokens renewed during the run; rejected ones were dropped from the cache
+        self.tokens = load_tokens()
+        self.upload_button.setEnabled(bool(self.tokens))
+        
+        if summary is None:
+            QMessageBox.critical(self, 'Error', 'An error occurred during upload. Please check log for details.')
             self.status_label.setText('Upload error. Please check log for details.')
+        elif summary['cancelled']:
+            self.status_label.setText(f"Upload cancelled. {summary['new']} new entries saved.")
+        else:
+            self.status_label.setText('Bill data uploaded successfully!')
+            QMessageBox.information(
+                self, 'Success',
+                f"Bill data has been processed and uploaded successfully.\n\n"
+                f"New entries: {summary['new']}\nSkipped: {summary['skipped']}\nErrors: {summary['errors']}")
+        
+        if not self.tokens:
+            self.status_label.setText('Login expired or was rejected. Please log in again.')
+    
+    def closeEvent(self, event):
+        # Let a running upload stop and save before the window goes away
+        if self.worker:
+            self.worker.cancel()
+            self.worker.wait()
+        super().closeEvent(event)
 
 def run():
     app = QApplication(sys.argv)
     app.setStyle('Fusion')  # Use Fusion style for a modern look
     window = LibertyBillUploader()
+    
+    # benchmark.py startup: report that the window is up and exit
+    if os.environ.get('STARTUP_BENCHMARK'):
+        QTimer.singleShot(0, lambda: (print("window-shown", flush=True), app.quit()))
+    else:
+        QTimer.singleShot(0, prewarm_imports)
     sys.exit(app.exec_())
 
 if __name__ == '__main__':
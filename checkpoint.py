@@ -0,0 +1,145 @@
+"""
+Crash-safe checkpointing for the Liberty Bill Uploader
+An append-only journal of accounts whose readings have been fetched, so an
+interrupted run can be resumed without calling the API again, and the
+schedule for saving the workbook partway through a run
+"""
+
+import json
+import os
+import time
+from datetime import datetime
+
+# Save the workbook after this many new rows or seconds, whichever comes first
+DEFAULT_SAVE_ROWS = 200
+DEFAULT_SAVE_SECONDS = 300
+
+# Usage fields holding datetimes, stored as ISO strings in the journal
+DATE_FIELDS = ("reading_date", "reading_from", "reading_to")
+
+def journal_path(excel_file):
+    """
+    Journal file for a workbook
+
+    CHECKPOINT_JOURNAL overrides the default of a .journal.jsonl file next to
+    the workbook; CHECKPOINT_JOURNAL=off disables journaling.
+
+    Returns:
+        str: Path of the journal, or None if journaling is disabled
+    """
+    path = os.environ.get('CHECKPOINT_JOURNAL')
+    if path is None:
+        return excel_file + ".journal.jsonl"
+    if path.lower() in ("off", "0", "false", ""):
+        return None
+    return path
+
+def encode_usages(usages):
+    return [{key: value.isoformat() if key in DATE_FIELDS and isinstance(value, datetime) else value
+             for key, value in usage.items()}
+            for usage in usages]
+
+def decode_usages(usages):
+    return [{key: datetime.fromisoformat(value) if key in DATE_FIELDS and value else value
+             for key, value in usage.items()}
+            for usage in usages]
+
+class CheckpointJournal:
+    """
+    Append-only JSON-lines journal of completed accounts
+
+    One line is written per account once its readings have been fetched and
+    queued, and flushed to disk straight away, so after a crash every line in
+    the file is an account that doesn't need the API again. Lines record the
+    sheet and date window they belong to; only lines matching the resumed run
+    are replayed.
+
+    Args:
+        path (str): Journal file
+        resume (bool): Keep the entries of the previous run; otherwise the
+            journal is started afresh
+    """
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.entries = {}
+        if resume:
+            self._load()
+        self.file = open(path, 'a' if resume else 'w')
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                record = json.loads(line)
+                key = (record["sheet"], record["start"], record["end"], record["account"])
+                self.entries[key] = decode_usages(record["usages"])
+            except (ValueError, KeyError, TypeError):
+                # A line cut short by the crash; that account is fetched again
+                continue
+
+    def completed(self, sheet_name, start_date_str, end_date_str):
+        """
+        Accounts already finished for a sheet and date window
+
+        Returns:
+            dict: Account number to its journaled list of usage data
+        """
+        return {account: usages for (sheet, start, end, account), usages in self.entries.items()
+                if (sheet, start, end) == (sheet_name, start_date_str, end_date_str)}
+
+    def record(self, sheet_name, start_date_str, end_date_str, account_number, usages):
+        """Append a completed account and its fetched readings, and flush it to disk"""
+        self.entries[(sheet_name, start_date_str, end_date_str, account_number)] = usages
+        self.file.write(json.dumps({
+            "sheet": sheet_name,
+            "start": start_date_str,
+            "end": end_date_str,
+            "account": account_number,
+            "usages": encode_usages(usages),
+        }) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+    def remove(self):
+        """Close and delete the journal once its run has been saved in full"""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+class SaveSchedule:
+    """
+    Decides when to save the workbook partway through a run
+
+    Args:
+        rows (int): Save once this many rows are waiting to be saved (0 disables)
+        seconds (float): Save once unsaved rows are this old (0 disables)
+    """
+    def __init__(self, rows=DEFAULT_SAVE_ROWS, seconds=DEFAULT_SAVE_SECONDS):
+        self.rows = rows
+        self.seconds = seconds
+        self.last_save = time.monotonic()
+
+    @classmethod
+    def from_env(cls):
+        """Schedule from CHECKPOINT_ROWS and CHECKPOINT_SECONDS"""
+        return cls(int(os.environ.get('CHECKPOINT_ROWS', DEFAULT_SAVE_ROWS)),
+                   float(os.environ.get('CHECKPOINT_SECONDS', DEFAULT_SAVE_SECONDS)))
+
+    def due(self, unsaved_rows):
+        if not unsaved_rows:
+            return False
+        if self.rows and unsaved_rows >= self.rows:
+            return True
+        return bool(self.seconds) and time.monotonic() - self.last_save >= self.seconds
+
+    def saved(self):
+        self.last_save = time.monotonic()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the Liberty Usage API
+Serves UsageAPI/api/V1/Electric with the same Result.electricUsages shape as
+the real endpoint (and Water and Gas the same way), with configurable
+latency, error rate and throttling, so the uploader can be benchmarked
+without touching the real service
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from collections import defaultdict, deque
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from liberty_api import COMMODITIES
+
+# Unit of measure reported for each commodity
+UNITS = {"Electric": "kWh", "Water": "Gal", "Gas": "Therm"}
+
+def reading_date(account_number, year, month):
+    """Day of the month an account's bill is read on; fixed per account"""
+    return datetime(year, month, zlib.crc32(str(account_number).encode()) % 28 + 1)
+
+def previous_month(year, month):
+    return (year - 1, 12) if month == 1 else (year, month - 1)
+
+def bill_amounts(account_number, year, month, commodity="Electric"):
+    """Deterministic (usage, cost) for an account's bill of a commodity"""
+    key = f"{account_number}-{year}-{month}"
+    if commodity != "Electric":
+        key += f"-{commodity}"
+    seed = zlib.crc32(key.encode())
+    usage = 500 + seed % 4500
+    return float(usage), round(usage * (0.10 + (seed % 7) / 100), 2)
+
+def usage_entry(account_number, year, month, commodity="Electric"):
+    """One Result.electricUsages (or water/gas) entry for the bill read in the given month"""
+    read = reading_date(account_number, year, month)
+    read_from = reading_date(account_number, *previous_month(year, month))
+    usage, cost = bill_amounts(account_number, year, month, commodity)
+    return {
+        "accountNumber": str(account_number),
+        "meterNumber": f"M{account_number}",
+        "readingDate": read.isoformat() + "Z",
+        "readingFrom": read_from.isoformat() + "Z",
+        "readingTo": read.isoformat() + "Z",
+        "usageValue": usage,
+        "usageCost": cost,
+        "uom": UNITS[commodity]
+    }
+
+def usage_entries(account_number, date_from, date_to, commodity="Electric"):
+    """
+    Bills for an account between two dates
+
+    For a single date (date_from == date_to) the latest bill on or before it
+    is returned, for a window every bill read inside it.
+    """
+    if date_from == date_to:
+        year, month = date_to.year, date_to.month
+        if reading_date(account_number, year, month) > date_to:
+            year, month = previous_month(year, month)
+        return [usage_entry(account_number, year, month, commodity)]
+
+    entries = []
+    year, month = date_to.year, date_to.month
+    while (year, month) >= (date_from.year, date_from.month):
+        if date_from <= reading_date(account_number, year, month) <= date_to:
+            entries.append(usage_entry(account_number, year, month, commodity))
+        year, month = previous_month(year, month)
+    return entries
+
+class FakeLibertyServer:
+    """
+    Threaded HTTP server mimicking the Usage API
+
+    Args:
+        latency (float): Mean seconds added to every response (jittered +/-50%)
+        error_rate (float): Fraction of requests answered with a 500
+        throttle_rate (float): Fraction of requests answered with a 429
+        retry_after (float): Retry-After seconds sent with 429 responses
+        rate_limit (float): Requests per second per token above which
+            requests get a 429, like the real per-client limit; None for no limit
+        port (int): Port to listen on; 0 picks a free one
+        revoked (iterable): Tokens answered with a 401, as if they had expired
+    """
+    def __init__(self, latency=0.2, error_rate=0.0, throttle_rate=0.0, retry_after=1.0, rate_limit=None, port=0,
+                 revoked=()):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.rate_limit = rate_limit
+        self.recent = defaultdict(deque)
+        self.revoked = set(revoked)
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "ok": 0, "errors": 0, "throttled": 0}
+
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        """Base URL to use as LIBERTY_API_URL"""
+        return f"http://127.0.0.1:{self.httpd.server_port}/UsageAPI/api/V1"
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def over_limit(self, token):
+        """Count a request against the token's rate limit; True if it exceeds it"""
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            recent = self.recent[token]
+            while recent and now - recent[0] >= 1.0:
+                recent.popleft()
+            if len(recent) >= self.rate_limit:
+                return True
+            recent.append(now)
+            return False
+    
+    def respond(self, handler, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def handle(self, handler):
+        self.count("requests")
+        if self.latency:
+            time.sleep(self.latency * random.uniform(0.5, 1.5))
+
+        url = urlparse(handler.path)
+        commodity = url.path.rsplit("/", 1)[-1]
+        if commodity not in COMMODITIES:
+            self.respond(handler, 404, {"error": "not found"})
+            return
+        token = handler.headers.get("authorization", "")
+        if not token.startswith("Bearer ") or token in self.revoked:
+            self.respond(handler, 401, {"error": "unauthorized"})
+            return
+
+        roll = random.random()
+        if roll < self.throttle_rate or self.over_limit(token):
+            self.count("throttled")
+            self.respond(handler, 429, {"error": "too many requests"}, {"Retry-After": str(self.retry_after)})
+            return
+        if roll < self.throttle_rate + self.error_rate:
+            self.count("errors")
+            self.respond(handler, 500, {"error": "internal error"})
+            return
+
+        query = parse_qs(url.query)
+        try:
+            account_number = query["AccountNumber"][0]
+            date_from = datetime.strptime(query["From"][0], "%Y-%m-%d")
+            date_to = datetime.strptime(query["To"][0], "%Y-%m-%d")
+        except (KeyError, ValueError):
+            self.respond(handler, 400, {"error": "bad request"})
+            return
+
+        self.count("ok")
+        self.respond(handler, 200, {"Result": {COMMODITIES[commodity]: usage_entries(account_number, date_from, date_to,
+                                                                                   commodity)}})
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Liberty Usage API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2, help="Mean response latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of 500 responses")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of 429 responses")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds on 429")
+    parser.add_argument("--rate-limit", type=float, help="Requests per second per token before answering 429")
+    args = parser.parse_args()
+
+    server = FakeLibertyServer(args.latency, args.error_rate, args.throttle_rate, args.retry_after,
+                               args.rate_limit, args.port)
+    print(f"Serving on {server.url} (set LIBERTY_API_URL to this)")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -1,70 +1,387 @@
 import requests
 import json
-from datetime import datetime
+import os
+import random
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from metrics import get_metrics
+from rate_limiter import wait_or_cancel
+from token_cache import discard_token
+from usage_cache import get_cache
 
-def fetch_electric_usage(account_number, date_str,token):
+# Liberty Usage API
+API_BASE_URL = "https://libertycf2-svc.smartcmobile.com/UsageAPI/api/V1"
+
+# Static headers sent with every request; the authorization header is added per request
+BASE_HEADERS = {
+    "accept": "application/json, text/plain, */*",
+    "accept-encoding": "gzip, deflate, br, zstd",
+    "accept-language": "en-US,en;q=0.9",
+    "origin": "https://myaccount.libertyenergyandwater.com",
+    "referer": "https://myaccount.libertyenergyandwater.com/",
+    "sec-ch-ua": '"Google Chrome";v="135", "Not-A.Brand";v="8", "Chromium";v="135"',
+    "sec-ch-ua-mobile": "?0",
+    "sec-ch-ua-platform": '"Windows"',
+    "sec-fetch-dest": "empty",
+    "sec-fetch-mode": "cors",
+    "sec-fetch-site": "cross-site",
+    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36"
+}
+
+# Usage API endpoint of each commodity and the Result key its periods come under
+COMMODITIES = {
+    "Electric": "electricUsages",
+    "Water": "waterUsages",
+    "Gas": "gasUsages",
+}
+
+# Bills are posted well within this many days of being read, so the answer
+# for a date window ending longer ago than this can't change any more
+FINAL_AFTER_DAYS = 60
+
+# Longest Retry-After honoured, in seconds; RETRY_AFTER_MAX overrides it
+DEFAULT_RETRY_AFTER_MAX = 300.0
+
+class NoLiveTokensError(Exception):
+    """The API rejected every token the client has: all of its TokenPool, or its token and the renewal failed"""
+
+class RequestCancelledError(Exception):
+    """The client's cancel event was set before a request could be sent"""
+
+# Responses worth retrying: throttling and server-side errors
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class LibertyClient:
+    """
+    Reusable Liberty API client
+    
+    Owns a pooled requests.Session so connections to the API are kept alive
+    between accounts, and retries connection errors and 5xx/429 responses with
+    jittered exponential backoff, honouring Retry-After when the API sends it.
+    A request the API asks to wait more than retry_after_max seconds for is
+    given up on instead.
+    With a limiter, every attempt (retries included) waits on it and reports
+    its outcome back, so an adaptive limiter can follow the API's health.
+    With a TokenPool, each attempt picks its token (and that token's limiter)
+    from the pool instead, moving on to another token when one is rejected
+    or throttled. With a TokenRenewer (and no pool), a rejected token is
+    renewed and the request is sent again with the new one.
+    Once its cancel_event is set, requests stop waiting (on the limiter, a
+    renewal or a backoff) and no further attempt is sent.
+    """
+    def __init__(self, timeout=(5, 30), max_retries=4, backoff_base=1.0, backoff_max=30.0, retry_after_max=None, pool_size=10, base_url=None, limiter=None, tokens=None, renewer=None, cancel_event=None):
+        # LIBERTY_API_URL points the client at another server, e.g. the local stand-in used by benchmark.py
+        self.base_url = base_url or os.environ.get('LIBERTY_API_URL', API_BASE_URL)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_after_max = retry_after_max or float(os.environ.get('RETRY_AFTER_MAX', DEFAULT_RETRY_AFTER_MAX))
+        self.limiter = limiter
+        self.tokens = tokens
+        self.renewer = renewer
+        self.cancel_event = cancel_event
+        
+        self.session = requests.Session()
+        self.session.headers.update(BASE_HEADERS)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+    
+    def _retry_delay(self, attempt, response=None):
+        """Seconds to wait before the next attempt"""
+        if response is not None:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is not None:
+                return retry_after
+        # Full jitter: uniform between 0 and the exponential backoff cap
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+    
+    def get(self, path, params, token):
+        """
+        Send a GET request to the Usage API, retrying transient failures
+        
+        Args:
+            path (str): Endpoint path below the base URL, e.g. "Electric"
+            params (dict): Query parameters
+            token (str): Bearer token for the authorization header; ignored
+                when the client has a TokenPool
+            
+        Returns:
+            requests.Response: The last response received
+            
+        Raises:
+            requests.RequestException: If every attempt failed to connect
+            NoLiveTokensError: If the client's TokenPool has no token left, or
+                its token was rejected and the renewer couldn't replace it
+            RequestCancelledError: If the cancel event was set
+        """
+        url = f"{self.base_url}/{path}"
+        metrics = get_metrics()
+        account_number = params.get("AccountNumber")
+        limiter = self.limiter
+        throttled_token = None
+        response = None
+        
+        for attempt in range(self.max_retries + 1):
+            if self.tokens:
+                token, limiter = self.tokens.pick(account_number, avoid=throttled_token)
+                if token is None:
+                    raise NoLiveTokensError("Every login token was rejected by the API")
+            elif self.renewer:
+                if self.renewer.failed:
+                    raise NoLiveTokensError("The login token was rejected by the API and could not be renewed")
+                # Waits while the token is being renewed
+                token = self.renewer.current(token, self.cancel_event)
+            headers = {"authorization": token} if token else None
+            if limiter:
+                limiter.acquire(self.cancel_event)
+            if self.cancel_event and self.cancel_event.is_set():
+                raise RequestCancelledError("Request cancelled")
+            start = time.perf_counter()
+            try:
+                response = self.session.get(url, headers=headers, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                latency = time.perf_counter() - start
+                metrics.observe_request(path, type(e).__name__, latency, account_number, attempt)
+                if limiter:
+                    limiter.record(type(e).__name__, latency)
+                if attempt == self.max_retries:
+                    raise
+                metrics.incr("api_retries")
+                delay = self._retry_delay(attempt)
+                print(f"Request failed ({e}), retrying in {delay:.1f}s...")
+                if wait_or_cancel(delay, self.cancel_event):
+                    raise RequestCancelledError("Request cancelled") from e
+                continue
+            latency = time.perf_counter() - start
+            metrics.observe_request(path, response.status_code, latency, account_number, attempt)
+            if limiter:
+                # The limiter pauses for Retry-After; not past the point where we give up
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                limiter.record(response.status_code, latency,
+                               min(retry_after, self.retry_after_max) if retry_after is not None else None)
+            
+            if self.tokens and response.status_code in (401, 403):
+                # Retire the rejected token and try the account on another one
+                self.tokens.retire(token)
+                if attempt == self.max_retries:
+                    return response
+                metrics.incr("api_retries")
+                continue
+            if self.renewer and not self.tokens and response.status_code in (401, 403):
+                if attempt < self.max_retries and self.renewer.renew(token):
+                    # Send the same request again with the renewed token
+                    metrics.incr("api_retries")
+                    continue
+                if self.renewer.failed:
+                    # Don't offer the dead token to the next run either
+                    discard_token(token)
+                    raise NoLiveTokensError("The login token was rejected by the API and could not be renewed")
+            
+            if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                return response
+            
+            if self.tokens and response.status_code == 429 and self.tokens.has_alternative(token):
+                # The other tokens have their own budgets; fail over without waiting
+                metrics.incr("api_retries")
+                throttled_token = token
+                continue
+            delay = self._retry_delay(attempt, response)
+            if delay > self.retry_after_max:
+                print(f"Status code {response.status_code}, the API asks to wait {delay:.0f}s; giving up on this request")
+                return response
+            metrics.incr("api_retries")
+            print(f"Status code {response.status_code}, retrying in {delay:.1f}s...")
+            if wait_or_cancel(delay, self.cancel_event):
+                raise RequestCancelledError("Request cancelled")
+    
+    def close(self):
+        self.session.close()
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header value
+    
+    Returns:
+        float: Seconds to wait, or None if the header is missing or invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+def get_client():
+    """Return the shared LibertyClient, creating it on first use"""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = LibertyClient()
+        return _default_client
+
+def usage_periods(api_response, commodity="Electric"):
+    """Usage periods of an API response for a commodity"""
+    return api_response["Result"][COMMODITIES[commodity]]
+
+def has_usage_periods(api_response, commodity="Electric"):
+    """Check if an API response contains at least one usage period"""
+    try:
+        return bool(usage_periods(api_response, commodity))
+    except (KeyError, TypeError):
+        return False
+
+def is_final_response(api_response, date_to_str, commodity="Electric"):
+    """
+    Check whether a response for a window ending on date_to_str can no longer change
+
+    It can't once a returned period reaches the end of the window, or once
+    the window ended FINAL_AFTER_DAYS ago; until then a newer bill may still
+    be posted for it.
+    """
+    if not has_usage_periods(api_response, commodity):
+        return False
+    date_to = datetime.strptime(date_to_str, "%Y-%m-%d")
+    if (datetime.now() - date_to).days >= FINAL_AFTER_DAYS:
+        return True
+    try:
+        latest = max(datetime.fromisoformat(period["readingTo"].replace("Z", ""))
+                     for period in usage_periods(api_response, commodity))
+    except (KeyError, TypeError, ValueError):
+        return False
+    return latest.date() >= date_to.date()
+
+def fetch_usage(account_number, date_str, token, client=None, end_date_str=None, use_cache=True, commodity="Electric"):
     """
-    Fetch electricity usage data from the Liberty API for a specific account and date
+    Fetch usage data of one commodity from the Liberty API for a specific account and date
     
     Args:
         account_number (str): The account number to query
         date_str (str): Date in YYYY-MM-DD format
+        token (str): Bearer token for the Liberty API; None if the client has a TokenPool
+        client (LibertyClient): Client to send the request with (shared client by default)
+        end_date_str (str): End of the date window in YYYY-MM-DD format; defaults to date_str
+        use_cache (bool): Look the response up in the on-disk cache first, and store it there
+        commodity (str): Key of COMMODITIES naming the endpoint to query
         
     Returns:
         dict: The API response data or None if the request failed
+        
+    Raises:
+        NoLiveTokensError, RequestCancelledError: See LibertyClient.get
     """
-    # URL for Liberty API
-    url = "https://libertycf2-svc.smartcmobile.com/UsageAPI/api/V1/Electric"
+    if commodity not in COMMODITIES:
+        raise ValueError(f"Unknown commodity: {commodity}")
+    client = client or get_client()
+    cache = get_cache() if use_cache else None
     
     # Query parameters (payload for GET)
     params = {
         "AccountNumber": account_number,
         "From": date_str,
-        "To": date_str,
+        "To": end_date_str or date_str,
         "Uom": "",
         "Periodicity": "MO",
         "IsNonAmi": "true"
     }
     
-    # Headers
-    headers = {
-        "accept": "application/json, text/plain, */*",
-        "accept-encoding": "gzip, deflate, br, zstd",
-        "accept-language": "en-US,en;q=0.9",
-        "authorization": token,
-        "origin": "https://myaccount.libertyenergyandwater.com",
-        "referer": "https://myaccount.libertyenergyandwater.com/",
-        "sec-ch-ua": '"Google Chrome";v="135", "Not-A.Brand";v="8", "Chromium";v="135"',
-        "sec-ch-ua-mobile": "?0",
-        "sec-ch-ua-platform": '"Windows"',
-        "sec-fetch-dest": "empty",
-        "sec-fetch-mode": "cors",
-        "sec-fetch-site": "cross-site",
-        "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36"
-    }
+    cache_key = (commodity, account_number, params["From"], params["To"], params["Periodicity"])
+    if cache:
+        try:
+            data = cache.get(*cache_key)
+        except sqlite3.Error as e:
+            # The cache is only an optimisation; fetch as if it missed
+            print(f"Warning: Usage cache lookup failed: {e}")
+            get_metrics().incr("cache_errors")
+            data = None
+        if data is not None:
+            print(f"Using cached data for account {account_number} on {date_str}")
+            get_metrics().incr("cache_hits")
+            return data
+        get_metrics().incr("cache_misses")
     
     try:
         # Send GET request
-        response = requests.get(url, headers=headers, params=params)
+        response = client.get(commodity, params, token)
         
         # Check if request was successful
         if response.status_code == 200:
             data = response.json()
-            print(f"Successfully fetched data for account {account_number} on {date_str}")
+            if cache:
+                # Answers that can't change any more are kept for good, the rest for the TTL
+                try:
+                    cache.put(*cache_key, data, final=is_final_response(data, params["To"], commodity))
+                except sqlite3.Error as e:
+                    print(f"Warning: Could not cache the response: {e}")
+                    get_metrics().incr("cache_errors")
+            if end_date_str:
+                print(f"Successfully fetched {commodity} data for account {account_number} from {date_str} to {end_date_str}")
+            else:
+                print(f"Successfully fetched {commodity} data for account {account_number} on {date_str}")
             return data
         else:
             print(f"Error fetching data: Status code {response.status_code}")
+            if response.status_code in (401, 403) and token:
+                # The token was rejected; don't offer it to the next run
+                discard_token(token)
             return None
+    except (NoLiveTokensError, RequestCancelledError):
+        raise
     except Exception as e:
         print(f"Exception occurred during API request: {e}")
         return None
 
-def extract_usage_data(api_response):
+def fetch_electric_usage(account_number, date_str,token, client=None, end_date_str=None, use_cache=True):
+    """Fetch electricity usage data for an account and date; see fetch_usage"""
+    return fetch_usage(account_number, date_str, token, client, end_date_str, use_cache, "Electric")
+
+def parse_usage_entry(usage_data):
+    """
+    Convert one usage period (e.g. an entry of Result.electricUsages) into the uploader's usage dict
+    
+    Args:
+        usage_data (dict): A single usage period from the API response
+        
+    Returns:
+        dict: Dictionary containing the extracted data
+    """
+    # Format dates properly
+    reading_date = datetime.fromisoformat(usage_data["readingDate"].replace("Z", ""))
+    reading_from = datetime.fromisoformat(usage_data["readingFrom"].replace("Z", ""))
+    reading_to = datetime.fromisoformat(usage_data["readingTo"].replace("Z", ""))
+    
+    # Extract and return the relevant data
+    return {
+        "account_number": usage_data["accountNumber"],
+        "meter_number": usage_data["meterNumber"],
+        "reading_date": reading_date,
+        "reading_from": reading_from,
+        "reading_to": reading_to,
+        "usage": usage_data["usageValue"],
+        "cost": usage_data["usageCost"],
+        "uom": usage_data["uom"]
+    }
+
+def extract_usage_data(api_response, commodity="Electric"):
     """
     Extract the relevant usage data from the API response
     
     Args:
-        api_response (dict): The API response from fetch_electric_usage
+        api_response (dict): The API response from fetch_usage
+        commodity (str): Commodity the response was fetched for
         
     Returns:
         dict: Dictionary containing extracted data or None if data is missing
@@ -73,54 +390,108 @@ def extract_usage_data(api_response):
         return None
     
     try:
-        # Extract the electric usage data from the response
-        electric_usages = api_response["Result"]["electricUsages"]
+        # Extract the usage data from the response
+        periods = usage_periods(api_response, commodity)
         
-        if not electric_usages or len(electric_usages) == 0:
+        if not periods or len(periods) == 0:
             print("No usage data found in the API response")
             return None
         
-        usage_data = electric_usages[0]
+        return parse_usage_entry(periods[0])
+    except Exception as e:
+        print(f"Error extracting usage data: {e}")
+        return None
+
+def extract_all_usage_data(api_response, commodity="Electric"):
+    """
+    Extract every usage period from the API response
+    
+    Periods are returned oldest first, with repeated (meter, reading date)
+    entries dropped.
+    
+    Args:
+        api_response (dict): The API response from fetch_usage
+        commodity (str): Commodity the response was fetched for
         
-        # Format dates properly
-        reading_date = datetime.fromisoformat(usage_data["readingDate"].replace("Z", ""))
-        reading_from = datetime.fromisoformat(usage_data["readingFrom"].replace("Z", ""))
-        reading_to = datetime.fromisoformat(usage_data["readingTo"].replace("Z", ""))
+    Returns:
+        list: Usage dicts as returned by extract_usage_data, or None if the response is invalid
+    """
+    if not api_response or "Result" not in api_response:
+        return None
+    
+    try:
+        periods = usage_periods(api_response, commodity) or []
+        
+        usages = []
+        seen = set()
+        for entry in periods:
+            usage_data = parse_usage_entry(entry)
+            key = (usage_data["meter_number"], usage_data["reading_date"])
+            if key in seen:
+                continue
+            seen.add(key)
+            usages.append(usage_data)
         
-        # Extract and return the relevant data
-        return {
-            "account_number": usage_data["accountNumber"],
-            "meter_number": usage_data["meterNumber"],
-            "reading_date": reading_date,
-            "reading_from": reading_from,
-            "reading_to": reading_to,
-            "usage": usage_data["usageValue"],
-            "cost": usage_data["usageCost"],
-            "uom": usage_data["uom"]
-        }
+        usages.sort(key=lambda usage_data: usage_data["reading_date"])
+        return usages
     except Exception as e:
         print(f"Error extracting usage data: {e}")
         return None
 
-def get_electricity_data(account_number, date_str,token):
+def get_usage_data(account_number, date_str, token, client=None, use_cache=True, commodity="Electric"):
     """
-    Fetch and extract electricity usage data for a given account and date
+    Fetch and extract usage data of one commodity for a given account and date
     
     Args:
         account_number (str): The account number to query
         date_str (str): Date in YYYY-MM-DD format
+        token (str): Bearer token for the Liberty API; None if the client has a TokenPool
+        client (LibertyClient): Client to send the request with (shared client by default)
+        use_cache (bool): Use the on-disk response cache
+        commodity (str): Key of COMMODITIES to query
         
     Returns:
         dict: Dictionary containing extracted usage data or None if data is missing
     """
     # Fetch data from the API
-    api_response = fetch_electric_usage(account_number, date_str,token)
+    api_response = fetch_usage(account_number, date_str, token, client, use_cache=use_cache, commodity=commodity)
     
     if not api_response:
         return None
     
     # Extract and return the usage data
-    return extract_usage_data(api_response)
+    return extract_usage_data(api_response, commodity)
+
+def get_usage_history(account_number, start_date_str, end_date_str, token, client=None, use_cache=True, commodity="Electric"):
+    """
+    Fetch every billing period of one commodity for an account between two dates in one request
+    
+    Args:
+        account_number (str): The account number to query
+        start_date_str (str): Start date in YYYY-MM-DD format
+        end_date_str (str): End date in YYYY-MM-DD format
+        token (str): Bearer token for the Liberty API; None if the client has a TokenPool
+        client (LibertyClient): Client to send the request with (shared client by default)
+        use_cache (bool): Use the on-disk response cache
+        commodity (str): Key of COMMODITIES to query
+        
+    Returns:
+        list: Usage dicts oldest first, or None if the request failed
+    """
+    api_response = fetch_usage(account_number, start_date_str, token, client, end_date_str, use_cache, commodity)
+    
+    if not api_response:
+        return None
+    
+    return extract_all_usage_data(api_response, commodity)
+
+def get_electricity_data(account_number, date_str,token, client=None, use_cache=True):
+    """Fetch and extract electricity usage data for a given account and date; see get_usage_data"""
+    return get_usage_data(account_number, date_str, token, client, use_cache)
+
+def get_electricity_history(account_number, start_date_str, end_date_str, token, client=None, use_cache=True):
+    """Fetch every electricity billing period for an account between two dates; see get_usage_history"""
+    return get_usage_history(account_number, start_date_str, end_date_str, token, client, use_cache)
 
 # Test function
 if __name__ == "__main__":
@@ -0,0 +1,198 @@
+"""
+Run metrics for the Liberty Bill Uploader
+Per-phase timers, counters and API request latencies for a run, written as
+JSON-lines run logs and optionally as a Prometheus textfile
+"""
+
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+DEFAULT_LOG_PATH = "uploader_metrics.jsonl"
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers, or None if it is empty"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[rank - 1]
+
+class RunMetrics:
+    """
+    Collects timings and counters for one uploader run
+
+    Every API request and phase timing is appended to the JSON-lines log as it
+    happens, and finish() appends a run summary line. Safe to use from the
+    fetch worker threads.
+    """
+    def __init__(self, log_path=None, prom_path=None, labels=None):
+        self.run_id = uuid.uuid4().hex[:12]
+        self.labels = labels or {}
+        self.prom_path = prom_path
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.phases = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.status_counts = defaultdict(int)
+        self.api_latencies = []
+        # Line buffered so concurrent batch workers appending to one log don't interleave lines
+        self.log_file = open(log_path, 'a', buffering=1) if log_path else None
+
+    def emit(self, event, **fields):
+        """Append one event to the run log"""
+        if not self.log_file:
+            return
+        record = {"ts": round(time.time(), 3), "run_id": self.run_id, "event": event}
+        record.update(self.labels)
+        record.update(fields)
+        line = json.dumps(record, default=str)
+        with self.lock:
+            if not self.log_file.closed:
+                self.log_file.write(line + "\n")
+
+    def add_time(self, phase, seconds):
+        with self.lock:
+            self.phases[phase] += seconds
+
+    @contextmanager
+    def timer(self, phase, log=True):
+        """
+        Time a block and add it to the phase total
+
+        Args:
+            phase (str): Phase name, e.g. "load" or "save"
+            log (bool): Also write a phase event to the run log; turn off for
+                small, frequent timings such as single duplicate checks
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.add_time(phase, seconds)
+            if log:
+                self.emit("phase", phase=phase, seconds=round(seconds, 6))
+
+    def incr(self, name, count=1):
+        with self.lock:
+            self.counters[name] += count
+
+    def observe_request(self, endpoint, status, latency, account_number=None, attempt=0):
+        """
+        Record one API request attempt
+
+        Args:
+            status: HTTP status code, or an exception class name if the request failed to connect
+        """
+        with self.lock:
+            self.api_latencies.append(latency)
+            self.status_counts[str(status)] += 1
+        self.emit("api_request", endpoint=endpoint, status=status, latency=round(latency, 6),
+                  account=account_number, attempt=attempt)
+
+    def summary(self):
+        with self.lock:
+            latencies = list(self.api_latencies)
+            return {
+                "duration": round(time.time() - self.started, 3),
+                "phases": {phase: round(seconds, 6) for phase, seconds in self.phases.items()},
+                "counters": dict(self.counters),
+                "api_requests": len(latencies),
+                "api_status": dict(self.status_counts),
+                "api_latency": {
+                    "p50": percentile(latencies, 0.50),
+                    "p95": percentile(latencies, 0.95),
+                    "max": max(latencies) if latencies else None,
+                },
+            }
+
+    def write_prometheus(self, summary):
+        """Write the run summary in Prometheus textfile-collector format"""
+        lines = [
+            "# HELP liberty_uploader_last_run_timestamp_seconds Time the last run finished",
+            "# TYPE liberty_uploader_last_run_timestamp_seconds gauge",
+            f"liberty_uploader_last_run_timestamp_seconds {time.time():.0f}",
+            "# HELP liberty_uploader_run_duration_seconds Wall time of the last run",
+            "# TYPE liberty_uploader_run_duration_seconds gauge",
+            f"liberty_uploader_run_duration_seconds {summary['duration']}",
+            "# HELP liberty_uploader_phase_seconds Time spent per phase in the last run",
+            "# TYPE liberty_uploader_phase_seconds gauge",
+        ]
+        lines += [f'liberty_uploader_phase_seconds{{phase="{phase}"}} {seconds}'
+                  for phase, seconds in sorted(summary['phases'].items())]
+        lines += [
+            "# HELP liberty_uploader_api_requests Usage API request attempts in the last run by status",
+            "# TYPE liberty_uploader_api_requests gauge",
+        ]
+        lines += [f'liberty_uploader_api_requests{{status="{status}"}} {count}'
+                  for status, count in sorted(summary['api_status'].items())]
+        lines += [
+            "# HELP liberty_uploader_api_latency_seconds Usage API request latency in the last run",
+            "# TYPE liberty_uploader_api_latency_seconds gauge",
+        ]
+        for quantile, key in (("0.5", "p50"), ("0.95", "p95"), ("1", "max")):
+            value = summary['api_latency'][key]
+            if value is not None:
+                lines.append(f'liberty_uploader_api_latency_seconds{{quantile="{quantile}"}} {value:.6f}')
+        lines += [
+            "# HELP liberty_uploader_events Counters from the last run",
+            "# TYPE liberty_uploader_events gauge",
+        ]
+        lines += [f'liberty_uploader_events{{name="{name}"}} {count}'
+                  for name, count in sorted(summary['counters'].items())]
+
+        # Write then rename so the collector never reads a half-written file
+        tmp_path = self.prom_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.prom_path)
+
+    def finish(self, **fields):
+        """
+        Write the run summary to the log (and Prometheus file) and close the log
+
+        Returns:
+            dict: The run summary
+        """
+        summary = self.summary()
+        self.emit("run_summary", **summary, **fields)
+        if self.prom_path:
+            self.write_prometheus(summary)
+        with self.lock:
+            if self.log_file:
+                self.log_file.close()
+        return summary
+
+# Metrics for the run in progress; a throwaway collector when no run was started
+_current = RunMetrics()
+
+def get_metrics():
+    """Return the metrics collector of the current run"""
+    return _current
+
+def start_run(**labels):
+    """
+    Start collecting metrics for a new run
+
+    METRICS_LOG sets the JSON-lines log file (METRICS_LOG=off disables it) and
+    METRICS_PROM, if set, the Prometheus textfile written when the run finishes.
+
+    Args:
+        labels: Fields added to every log line, e.g. workbook=...
+
+    Returns:
+        RunMetrics: The new current collector
+    """
+    global _current
+    log_path = os.environ.get('METRICS_LOG', DEFAULT_LOG_PATH)
+    if log_path.lower() in ("off", "0", "false", ""):
+        log_path = None
+    _current = RunMetrics(log_path, os.environ.get('METRICS_PROM'), labels)
+    _current.emit("run_start")
+    return _current
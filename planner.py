@@ -0,0 +1,143 @@
+"""
+Incremental fetch planning for the Liberty Bill Uploader
+Uses the reading dates already on the sheet to skip accounts whose next bill
+can't be out yet, so a run only calls the API for accounts that may have one
+"""
+
+from datetime import datetime, timedelta
+from statistics import median
+
+from row_store import NO_ACCOUNT, NO_DATE
+
+# Billing cycle assumed for accounts with fewer than two readings on the sheet
+DEFAULT_CYCLE_DAYS = 30
+
+# Bounds for an account's estimated cycle (monthly up to quarterly billing)
+MIN_CYCLE_DAYS = 20
+MAX_CYCLE_DAYS = 100
+
+# Readings closer together than this are corrections, not billing cycles
+MIN_READING_GAP_DAYS = 10
+
+# A bill may be read this many days earlier than the cycle suggests
+EARLY_READING_DAYS = 5
+
+# Readings further apart than this many cycles have a bill missing between them
+MISSING_GAP_CYCLES = 1.5
+
+def reading_dates(table):
+    """
+    Group the sheet's reading dates by account
+
+    Args:
+        table (SheetTable): Sheet rows as returned by load_sheet_data
+
+    Returns:
+        dict: Account number to its sorted list of distinct reading dates
+    """
+    ordinals = {}
+    for account_id, ordinal in zip(table.accounts, table.dates):
+        if account_id != NO_ACCOUNT and ordinal != NO_DATE:
+            ordinals.setdefault(account_id, set()).add(ordinal)
+    return {table.account_numbers[account_id]: [datetime.fromordinal(ordinal) for ordinal in sorted(days)]
+            for account_id, days in ordinals.items()}
+
+def billing_cycle_days(dates):
+    """
+    Typical number of days between an account's readings
+
+    Args:
+        dates (list): Sorted reading dates of one account
+
+    Returns:
+        float: Median gap between readings, clamped to a plausible cycle
+    """
+    gaps = [(later - earlier).days for earlier, later in zip(dates, dates[1:])]
+    gaps = [gap for gap in gaps if gap >= MIN_READING_GAP_DAYS]
+    if not gaps:
+        return DEFAULT_CYCLE_DAYS
+    return min(MAX_CYCLE_DAYS, max(MIN_CYCLE_DAYS, median(gaps)))
+
+def next_reading_due(dates, cycle=None):
+    """
+    Earliest date the account's next bill could be read, or None if it has no readings
+
+    Args:
+        dates (list): Sorted reading dates of one account
+        cycle (float): Billing cycle in days; estimated from dates if None
+    """
+    if not dates:
+        return None
+    cycle = cycle or billing_cycle_days(dates)
+    return dates[-1] + timedelta(days=cycle - EARLY_READING_DAYS)
+
+def has_every_reading(dates, start_date, end_date):
+    """
+    Check whether the sheet has a reading for every billing cycle between two dates
+
+    Args:
+        dates (list): Sorted reading dates of one account
+        start_date (datetime): Start of the backfill window
+        end_date (datetime): End of the backfill window
+
+    Returns:
+        bool: False if a bill in the window could be missing from the sheet
+    """
+    cycle = billing_cycle_days(dates)
+    before = [day for day in dates if day < start_date]
+    window = [day for day in dates if start_date <= day <= end_date]
+    if not window:
+        return False
+
+    # From the last reading before the window (or the window's start if the
+    # account has none) through every reading in it, no cycle may be skipped
+    if before:
+        points = before[-1:] + window
+    else:
+        points = window
+        if (window[0] - start_date).days > cycle:
+            return False
+    for earlier, later in zip(points, points[1:]):
+        if (later - earlier).days > cycle * MISSING_GAP_CYCLES:
+            return False
+    return next_reading_due(window, cycle) > end_date
+
+def plan_accounts(account_numbers, dates_by_account, target_date, force=False, start_date=None):
+    """
+    Split accounts into those worth querying and those that can't have a new bill yet
+
+    For a single date, an account is skipped when the next reading after its
+    latest one on or before target_date isn't due until after target_date,
+    i.e. the newest bill on or before target_date is already on the sheet.
+    For a backfill window (start_date to target_date), an account is skipped
+    only when the sheet has a reading for every cycle in the window.
+    Readings after target_date are never taken as proof of anything, and
+    accounts without dated rows are always queried.
+
+    Args:
+        account_numbers (list): Accounts in processing order
+        dates_by_account (dict): As returned by reading_dates
+        target_date (datetime): Date being processed (the end date in backfill mode)
+        force (bool): Query every account
+        start_date (datetime): Start date in backfill mode, or None
+
+    Returns:
+        tuple: (accounts to query in their original order, dict of skipped
+        account number to the date its next bill is due)
+    """
+    if force:
+        return list(account_numbers), {}
+
+    to_query = []
+    not_due = {}
+    for account_number in account_numbers:
+        dates = dates_by_account.get(account_number) or []
+        known = [day for day in dates if day <= target_date]
+        due = next_reading_due(known, billing_cycle_days(dates)) if known else None
+        if start_date is not None and not has_every_reading(dates, start_date, target_date):
+            due = None
+        if due is not None and due > target_date:
+            not_due[account_number] = due
+        else:
+            to_query.append(account_number)
+    return to_query, not_due
@@ -0,0 +1,298 @@
+"""
+Rate limiting for Liberty API requests
+Shared between fetch worker threads (and processes, for batch runs) so the
+total request rate stays bounded, with an adaptive controller that tunes the
+rate to what the API currently allows
+"""
+
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+from metrics import get_metrics
+
+DEFAULT_STATE_PATH = os.path.join(os.path.expanduser("~"), ".liberty_bill_uploader", "rate_state.json")
+
+# Bounds and starting point for the adaptive rate (requests per second)
+DEFAULT_MIN_RATE = 0.2
+DEFAULT_MAX_RATE = 20.0
+DEFAULT_START_RATE = 2.0
+
+# Responses that mean the API wants us to slow down
+THROTTLE_STATUS_CODES = {429, 503}
+
+def wait_or_cancel(seconds, cancel_event=None):
+    """
+    Sleep for seconds, or until cancel_event is set
+
+    Returns:
+        bool: True if cancel_event was set
+    """
+    if cancel_event is None:
+        time.sleep(seconds)
+        return False
+    return cancel_event.wait(seconds)
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiter
+
+    Tokens are added at `rate` per second up to `capacity`. Each request takes
+    one token, blocking until one is available.
+    """
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, cancel_event=None):
+        """
+        Block until a token is available, then take it
+
+        Args:
+            cancel_event (threading.Event): Stop waiting once it is set
+
+        Returns:
+            bool: True once a token was taken, False if cancel_event was set first
+        """
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if wait_or_cancel(wait, cancel_event):
+                return False
+
+    def update_rate(self, func):
+        """
+        Replace the rate with func(current rate), atomically
+
+        Returns:
+            float: The new rate
+        """
+        with self.lock:
+            self._refill()
+            self.rate = func(self.rate)
+            return self.rate
+
+    def pause(self, seconds):
+        """Hand out no tokens for the next `seconds` (e.g. a Retry-After)"""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def record(self, status, latency, retry_after=None):
+        """Response feedback; a fixed-rate bucket ignores it"""
+
+class SharedTokenBucket:
+    """
+    Token bucket whose state lives in shared memory, for use across processes
+
+    Create it in the parent and hand it to worker processes when they start
+    (e.g. through a process pool initializer); every process then draws from
+    the same budget.
+    """
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.lock = multiprocessing.Lock()
+        self._rate = multiprocessing.Value('d', rate, lock=False)
+        self.tokens = multiprocessing.Value('d', self.capacity, lock=False)
+        self.updated = multiprocessing.Value('d', time.monotonic(), lock=False)
+
+    @property
+    def rate(self):
+        return self._rate.value
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens.value = min(self.capacity, self.tokens.value + (now - self.updated.value) * self._rate.value)
+        self.updated.value = now
+
+    def acquire(self, cancel_event=None):
+        """Block until a token is available, then take it; see TokenBucket.acquire"""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens.value >= 1:
+                    self.tokens.value -= 1
+                    return True
+                wait = (1 - self.tokens.value) / self._rate.value
+            if wait_or_cancel(wait, cancel_event):
+                return False
+
+    def update_rate(self, func):
+        """
+        Replace the rate with func(current rate), atomically across processes
+
+        Returns:
+            float: The new rate
+        """
+        with self.lock:
+            self._refill()
+            self._rate.value = func(self._rate.value)
+            return self._rate.value
+
+    def pause(self, seconds):
+        """Hand out no tokens for the next `seconds` (e.g. a Retry-After)"""
+        with self.lock:
+            self._refill()
+            self.tokens.value = min(self.tokens.value, 1 - seconds * self._rate.value)
+
+    def record(self, status, latency, retry_after=None):
+        """Response feedback; a fixed-rate bucket ignores it"""
+
+def state_path():
+    return os.environ.get('RATE_STATE', DEFAULT_STATE_PATH)
+
+def load_rate(path=None):
+    """
+    Rate saved at the end of the last run
+
+    Returns:
+        float: Requests per second, or None if nothing usable was saved
+    """
+    try:
+        with open(path or state_path(), 'r') as f:
+            rate = float(json.load(f)["rate"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return rate if rate > 0 else None
+
+def save_rate(rate, path=None):
+    """Save the rate for the next run to start from"""
+    path = path or state_path()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({"rate": rate, "saved_at": time.time()}, f)
+    os.replace(tmp_path, path)
+
+def adaptive_enabled():
+    """Adaptive rate control is on unless ADAPTIVE_RATE=off"""
+    return os.environ.get('ADAPTIVE_RATE', 'on').lower() not in ("off", "0", "false")
+
+def start_rate():
+    """
+    Rate a run starts at: the rate saved by the last run, or FETCH_RATE if
+    nothing was saved (or adaptive control is off)
+    """
+    saved = load_rate() if adaptive_enabled() else None
+    rate = saved or float(os.environ.get('FETCH_RATE', DEFAULT_START_RATE))
+    min_rate = float(os.environ.get('FETCH_RATE_MIN', DEFAULT_MIN_RATE))
+    max_rate = float(os.environ.get('FETCH_RATE_MAX', DEFAULT_MAX_RATE))
+    return min(max_rate, max(min_rate, rate)) if saved else rate
+
+class AdaptiveRateLimiter:
+    """
+    AIMD controller over a token bucket
+
+    Every response fed to record() adjusts the bucket's rate: a fast success
+    (2xx) adds `increase` requests per second for every `rate` successes (so
+    roughly +increase per second of healthy traffic), while throttling (429/503),
+    connection failures and latency above twice `latency_target` cut the rate
+    by `decrease`, at most once per cooldown so one burst of rejected
+    requests in flight counts as a single signal. Retry-After pauses the
+    bucket for everyone, not just the request that got it.
+
+    Args:
+        bucket: TokenBucket, or a SharedTokenBucket to adapt one rate across processes
+        min_rate (float): Lowest rate the controller backs off to
+        max_rate (float): Highest rate it climbs to
+        increase (float): Additive increase, requests per second
+        decrease (float): Multiplicative decrease factor
+        latency_target (float): Seconds; slower responses stop the increase
+    """
+    def __init__(self, bucket, min_rate=DEFAULT_MIN_RATE, max_rate=DEFAULT_MAX_RATE, increase=0.5,
+                 decrease=0.7, latency_target=2.0, cooldown=1.0):
+        self.bucket = bucket
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self.last_decrease = 0.0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, bucket=None):
+        """
+        Build a controller with settings from the environment
+
+        FETCH_RATE_MIN and FETCH_RATE_MAX bound the rate and
+        FETCH_LATENCY_TARGET sets the latency target.
+
+        Args:
+            bucket: Bucket to adapt; a new TokenBucket at start_rate() if None
+        """
+        min_rate = float(os.environ.get('FETCH_RATE_MIN', DEFAULT_MIN_RATE))
+        max_rate = float(os.environ.get('FETCH_RATE_MAX', DEFAULT_MAX_RATE))
+        if bucket is None:
+            rate = start_rate()
+            # The burst size stays small as the rate climbs
+            bucket = TokenBucket(rate, capacity=max(1.0, min(rate, 4.0)))
+        return cls(bucket, min_rate, max_rate,
+                   latency_target=float(os.environ.get('FETCH_LATENCY_TARGET', 2.0)))
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    def acquire(self, cancel_event=None):
+        """Block until the current rate allows another request; see TokenBucket.acquire"""
+        return self.bucket.acquire(cancel_event)
+
+    def _back_off(self, reason):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_decrease < self.cooldown:
+                return
+            self.last_decrease = now
+        rate = self.bucket.update_rate(lambda rate: max(self.min_rate, rate * self.decrease))
+        metrics = get_metrics()
+        metrics.incr("rate_decreases")
+        metrics.emit("rate_change", rate=round(rate, 3), reason=reason)
+
+    def record(self, status, latency, retry_after=None):
+        """
+        Feed back the outcome of one request attempt
+
+        Args:
+            status: HTTP status code, or an exception class name if the request failed to connect
+            latency (float): Seconds the attempt took
+            retry_after (float): Retry-After seconds sent by the API, if any
+        """
+        if retry_after:
+            self.bucket.pause(retry_after)
+
+        if not isinstance(status, int):
+            self._back_off(str(status))
+        elif status in THROTTLE_STATUS_CODES:
+            self._back_off(str(status))
+        elif latency > 2 * self.latency_target:
+            self._back_off("latency")
+        elif 200 <= status < 300 and latency <= self.latency_target:
+            # Only successes count as healthy; a 401/403/404 says nothing about the API's load
+            self.bucket.update_rate(lambda rate: min(self.max_rate, rate + self.increase / rate))
+
+    def save_state(self):
+        """Save the current rate as the starting point for the next run"""
+        try:
+            save_rate(self.rate)
+        except OSError as e:
+            print(f"Warning: Could not save the request rate: {e}")
@@ -0,0 +1,158 @@
+"""
+Compact in-memory store for dashboard sheet rows
+Keeps the columns the uploader uses in typed arrays, with account numbers
+interned to small integers and dates stored as day ordinals, instead of one
+dict per row
+"""
+
+import math
+import sys
+from array import array
+from datetime import date, datetime
+
+NO_ACCOUNT = -1
+
+# Date ordinals start at 1, so 0 marks a date cell that isn't a date
+NO_DATE = 0
+
+def date_ordinal(value):
+    """Day ordinal of a date or datetime cell value, or NO_DATE for anything else"""
+    if isinstance(value, date):
+        return value.toordinal()
+    return NO_DATE
+
+def to_float(value):
+    """Numeric cell value as a float; NaN for empty or non-numeric cells"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return math.nan
+
+class SheetTable:
+    """
+    Columnar table of sheet rows
+
+    Every sheet row is one position in parallel arrays: row number, account
+    id, date ordinal, usage, rate, cost, SQFT and building id. Building names
+    repeat down the rows of an account, so each distinct name is stored once
+    and rows refer to it by id. The uploader only needs an account's latest
+    building name and SQFT, which are also kept per account. Date cells that
+    don't hold a date are kept as they are in a sparse side map, so no value
+    the duplicate check looks at is lost.
+    """
+    def __init__(self):
+        # Per account, indexed by account id
+        self.account_numbers = []
+        self.account_ids = {}
+        self.buildings = []
+        self.sqfts = []
+
+        # Distinct building names, indexed by building id
+        self.building_names = []
+        self.building_ids = {}
+
+        # Per row
+        self.rows = array('l')
+        self.accounts = array('l')
+        self.dates = array('l')
+        self.usage = array('d')
+        self.rate = array('d')
+        self.cost = array('d')
+        self.row_sqfts = array('d')
+        self.row_buildings = array('l')
+        self.raw_dates = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def intern(self, account_number):
+        """Id of an account, adding it to the table if it is new"""
+        account_id = self.account_ids.get(account_number)
+        if account_id is None:
+            account_id = len(self.account_numbers)
+            self.account_ids[account_number] = account_id
+            self.account_numbers.append(sys.intern(account_number))
+            self.buildings.append(None)
+            self.sqfts.append(None)
+        return account_id
+
+    def account_id(self, account_number):
+        """Id of an account, or None if it has no rows"""
+        return self.account_ids.get(account_number)
+
+    def append(self, row, date_value, building_name, account_number, usage, rate, cost, sqft):
+        """
+        Add a sheet row
+
+        The account's building name and SQFT are updated to the row's values,
+        SQFT only when the row has one.
+
+        Returns:
+            int: Position of the row in the table
+        """
+        position = len(self.rows)
+        account_id = NO_ACCOUNT
+        if account_number:
+            account_id = self.intern(account_number)
+            self.buildings[account_id] = building_name
+            if sqft or self.sqfts[account_id] is None:
+                self.sqfts[account_id] = sqft
+
+        ordinal = date_ordinal(date_value)
+        if ordinal == NO_DATE and date_value is not None:
+            self.raw_dates[position] = date_value
+
+        building_id = self.building_ids.get(building_name)
+        if building_id is None:
+            building_id = len(self.building_names)
+            self.building_ids[building_name] = building_id
+            self.building_names.append(building_name)
+
+        self.rows.append(row)
+        self.accounts.append(account_id)
+        self.dates.append(ordinal)
+        self.usage.append(to_float(usage))
+        self.rate.append(to_float(rate))
+        self.cost.append(to_float(cost))
+        self.row_sqfts.append(to_float(sqft))
+        self.row_buildings.append(building_id)
+        return position
+
+    def building(self, account_number):
+        """Latest building name of the account, or None if it has no rows"""
+        account_id = self.account_ids.get(account_number)
+        return self.buildings[account_id] if account_id is not None else None
+
+    def sqft(self, account_number):
+        """Latest SQFT of the account, or None"""
+        account_id = self.account_ids.get(account_number)
+        return self.sqfts[account_id] if account_id is not None else None
+
+    def date_at(self, position):
+        """Date cell of a row: a datetime, its raw value if it isn't a date, or None"""
+        ordinal = self.dates[position]
+        if ordinal != NO_DATE:
+            return datetime.fromordinal(ordinal)
+        return self.raw_dates.get(position)
+
+    def records(self):
+        """
+        Rows as per-row dicts, for code written against the old row records
+
+        Each row has its own building name and SQFT, not the account's latest.
+        Empty and non-numeric number cells are NaN.
+
+        Yields:
+            dict: row, date, building_name, account_number, usage, rate, cost and sqft
+        """
+        for position in range(len(self.rows)):
+            account_id = self.accounts[position]
+            yield {
+                'row': self.rows[position],
+                'date': self.date_at(position),
+                'building_name': self.building_names[self.row_buildings[position]],
+                'account_number': self.account_numbers[account_id] if account_id != NO_ACCOUNT else None,
+                'usage': self.usage[position],
+                'rate': self.rate[position],
+                'cost': self.cost[position],
+                'sqft': self.row_sqfts[position]
+            }
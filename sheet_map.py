@@ -0,0 +1,77 @@
+"""
+Sheet to commodity mapping for the Liberty Bill Uploader
+Says which Usage API commodity (Electric, Water, Gas) fills each dashboard
+sheet, so one run can update every utility sheet of a workbook
+"""
+
+import json
+import os
+
+from liberty_api import COMMODITIES
+
+# Sheets processed when no mapping is configured
+DEFAULT_SHEETS = {"COLEVILLE ELECTRICITY": "Electric"}
+
+# Words in a sheet name that identify its commodity
+SHEET_NAME_HINTS = {
+    "WATER": "Water",
+    "GAS": "Gas",
+    "ELECTRIC": "Electric",
+}
+
+def commodity_for_sheet(sheet_name):
+    """Commodity a sheet is for, going by its name; Electric if the name doesn't say"""
+    name = sheet_name.upper()
+    for hint, commodity in SHEET_NAME_HINTS.items():
+        if hint in name:
+            return commodity
+    return "Electric"
+
+def normalize_sheets(sheets):
+    """
+    Sheet mapping from a list of sheet names or a dict of sheet name to commodity
+
+    Listed sheets get their commodity from their name (see
+    commodity_for_sheet); commodity names are matched case-insensitively.
+
+    Returns:
+        dict: Sheet name to commodity, in processing order
+
+    Raises:
+        ValueError: If a commodity isn't one of liberty_api.COMMODITIES
+    """
+    if isinstance(sheets, dict):
+        pairs = sheets.items()
+    else:
+        pairs = ((sheet_name, commodity_for_sheet(sheet_name)) for sheet_name in sheets)
+
+    names = {commodity.lower(): commodity for commodity in COMMODITIES}
+    mapping = {}
+    for sheet_name, commodity in pairs:
+        if str(commodity).lower() not in names:
+            raise ValueError(f"Unknown commodity for sheet {sheet_name}: {commodity} "
+                             f"(expected one of {', '.join(COMMODITIES)})")
+        mapping[sheet_name] = names[str(commodity).lower()]
+    return mapping
+
+def load_sheet_map(path=None):
+    """
+    Sheet mapping for a run
+
+    Read from the JSON file at path (or SHEET_MAP), which holds either a
+    "sheets" object of sheet name to commodity or a list of sheet names,
+    e.g. {"sheets": {"COLEVILLE ELECTRICITY": "Electric", "COLEVILLE WATER": "Water"}}.
+    Without a file, DEFAULT_SHEETS is used.
+
+    Returns:
+        dict: Sheet name to commodity, in processing order
+    """
+    path = path or os.environ.get('SHEET_MAP')
+    if not path:
+        return dict(DEFAULT_SHEETS)
+    with open(path, 'r') as f:
+        config = json.load(f)
+    sheets = config.get("sheets") if isinstance(config, dict) else config
+    if not sheets:
+        raise ValueError(f"No sheets listed in {path}")
+    return normalize_sheets(sheets)
@@ -4,13 +4,51 @@ Simplified Liberty Bill Uploader
 Automatically fetches and uploads utility bill data for all accounts
 """
 
-import xlwings as xw
-import pandas as pd
 from datetime import datetime
 import re
 import time
 import os
-from liberty_api import get_electricity_data
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from checkpoint import CheckpointJournal, SaveSchedule, journal_path
+from liberty_api import LibertyClient, NoLiveTokensError, RequestCancelledError, get_usage_data, get_usage_history
+from metrics import get_metrics, start_run
+from planner import plan_accounts, reading_dates
+from row_store import NO_ACCOUNT, NO_DATE, SheetTable, date_ordinal
+from sheet_map import load_sheet_map, normalize_sheets
+from rate_limiter import AdaptiveRateLimiter, TokenBucket, adaptive_enabled, start_rate
+from token_cache import load_tokens
+from token_pool import TokenPool
+from token_renewal import TokenRenewer
+from usage_history import UsageHistory, history_path
+from workbook_backend import open_workbook
+
+# Header text and fallback column index for the columns the uploader uses
+COLUMN_HEADERS = {
+    'date': ("Date", 0),
+    'building': ("Building Name", 3),
+    'usage': ("Usage", 6),
+    'rate': ("Rate ($/kWh))", 7),
+    'cost': ("Cost ($)", 8),
+    'sqft': ("SQFT", 9),
+}
+
+# Rows fetched per range read when loading the sheet
+READ_CHUNK_ROWS = 5000
+
+# Date ordinals are below this, so (account id, day) packs into one integer
+ORDINAL_SPAN = 1 << 22
+
+# Concurrent API requests
+DEFAULT_FETCH_WORKERS = 4
+
+# Fetched accounts allowed to wait for the writer, per fetch worker
+DEFAULT_QUEUE_PER_WORKER = 4
+
+# New rows written to the sheet at a time while fetching continues
+DEFAULT_WRITE_BATCH_ROWS = 100
 
 def extract_account_number(building_name_text):
     """Extract account number from the building name text"""
@@ -25,7 +63,7 @@ def extract_account_number(building_name_text):
 def format_date_for_comparison(date_obj):
     """Format a date object to a standard string format for comparison"""
     if isinstance(date_obj, datetime):
-        return date_obj.strftime("%Y-%m-%d")
+        return date_obj.date().isoformat()
     return str(date_obj)
 
 def check_existing_entry(data, account_number, check_date):
@@ -43,118 +81,616 @@ def check_existing_entry(data, account_number, check_date):
     
     return False
 
-def main(token):
-    try:
-        print("===== Liberty Bill Uploader =====")
-        
-        # Get the date from environment variable or prompt user if not provided
-        start_date_str = os.environ.get('SELECTED_DATE')
-        if not start_date_str:
-            while True:
-                start_date_str = input("Enter date to process (YYYY-MM-DD): ")
-                try:
-                    start_date = datetime.strptime(start_date_str, "%Y-%m-%d")
-                    break
-                except ValueError:
-                    print("Invalid date format. Please use YYYY-MM-DD.")
-        else:
+class SheetIndex:
+    """
+    Lookup structure over the sheet rows, built once at load time
+    
+    Holds the (account, day) pairs already on the sheet, packed into single
+    integers, plus the first and last row and the latest reading date of
+    every account, so duplicate checks and template lookups don't scan every
+    row. Account ids come from the SheetTable the index is built over.
+    """
+    def __init__(self, table):
+        self.table = table
+        self.entries = set()
+        # (account id, normalized value) for date cells that aren't dates
+        self.other_entries = set()
+        # Per account id
+        self.first_rows = []
+        self.last_rows = []
+        self.last_dates = []
+    
+    @classmethod
+    def from_table(cls, table):
+        """Build an index over every row of a SheetTable"""
+        index = cls(table)
+        for position, (account_id, ordinal) in enumerate(zip(table.accounts, table.dates)):
+            if account_id == NO_ACCOUNT:
+                continue
+            if ordinal != NO_DATE:
+                key = account_id * ORDINAL_SPAN + ordinal
+            else:
+                key = index._key(account_id, table.raw_dates.get(position))
+            index._add(account_id, key, table.rows[position])
+        return index
+    
+    @staticmethod
+    def _key(account_id, date):
+        """Packed (account id, day) for dates and ISO date text, a tuple for anything else"""
+        ordinal = date_ordinal(date)
+        if ordinal == NO_DATE:
+            # Text that reads exactly as an ISO date compares equal to that date
+            text = format_date_for_comparison(date)
             try:
-                start_date = datetime.strptime(start_date_str, "%Y-%m-%d")
+                parsed = datetime.strptime(text, "%Y-%m-%d")
             except ValueError:
-                print(f"Invalid date format: {start_date_str}. Using current date.")
-                start_date = datetime.now()
-                start_date_str = start_date.strftime("%Y-%m-%d")
+                return account_id, text
+            if parsed.date().isoformat() != text:
+                return account_id, text
+            ordinal = parsed.toordinal()
+        return account_id * ORDINAL_SPAN + ordinal
+    
+    def _add(self, account_id, key, row):
+        if isinstance(key, tuple):
+            self.other_entries.add(key)
+        else:
+            self.entries.add(key)
         
-        # Open the Excel file
-        print("\nOpening Excel file...")
-        excel_file = os.environ.get('EXCEL_FILE', "MWTC UTILITY BILLS - DASHBOARD.xlsm")
-        wb = xw.Book(excel_file)
-        sheet = wb.sheets["COLEVILLE ELECTRICITY"]
-        
-        # Get dimensions
-        last_row = sheet.used_range.last_cell.row
-        
-        # Read headers to identify columns
-        headers = sheet.range("A1:Z1").value
-        
-        # Find indices of important columns
-        date_col_idx = headers.index("Date") if "Date" in headers else 0
-        building_col_idx = headers.index("Building Name") if "Building Name" in headers else 3
-        usage_col_idx = headers.index("Usage") if "Usage" in headers else 6
-        rate_col_idx = headers.index("Rate ($/kWh))") if "Rate ($/kWh))" in headers else 7
-        cost_col_idx = headers.index("Cost ($)") if "Cost ($)" in headers else 8
-        sqft_col_idx = headers.index("SQFT") if "SQFT" in headers else 9
-        
-        # Read all data from the sheet
-        data = []
-        account_numbers = set()
-        account_to_building = {}
-        account_to_sqft = {}
-        
-        print("Extracting data and account numbers...")
-        for i in range(2, last_row + 1):
-            row_data = sheet.range(f"A{i}:{chr(65 + max(building_col_idx, usage_col_idx, rate_col_idx, cost_col_idx, sqft_col_idx))}{i}").value
-            
-            # Extract account number from building name
-            building_name = row_data[building_col_idx] if building_col_idx < len(row_data) else None
-            account_number = extract_account_number(building_name)
-            
-            # Get SQFT value
-            sqft_value = row_data[sqft_col_idx] if sqft_col_idx < len(row_data) else None
-            
-            if account_number:
-                account_numbers.add(account_number)
-                account_to_building[account_number] = building_name
-                if sqft_value:
-                    account_to_sqft[account_number] = sqft_value
-                
-            data.append({
-                'row': i,
-                'date': row_data[date_col_idx] if date_col_idx < len(row_data) else None,
-                'building_name': building_name,
-                'account_number': account_number,
-                'usage': row_data[usage_col_idx] if usage_col_idx < len(row_data) else None,
-                'rate': row_data[rate_col_idx] if rate_col_idx < len(row_data) else None,
-                'cost': row_data[cost_col_idx] if cost_col_idx < len(row_data) else None,
-                'sqft': sqft_value
-            })
+        while account_id >= len(self.first_rows):
+            self.first_rows.append(None)
+            self.last_rows.append(None)
+            self.last_dates.append(NO_DATE)
+        if self.first_rows[account_id] is None or row < self.first_rows[account_id]:
+            self.first_rows[account_id] = row
+        if self.last_rows[account_id] is None or row > self.last_rows[account_id]:
+            self.last_rows[account_id] = row
         
-        # Get all accounts
-        account_numbers_list = sorted(list(account_numbers))
-        print(f"Found {len(account_numbers_list)} accounts to process")
+        if not isinstance(key, tuple):
+            self.last_dates[account_id] = max(self.last_dates[account_id], key % ORDINAL_SPAN)
+    
+    def add(self, account_number, date, row):
+        """Record a row for an account; call this for every row appended to the sheet"""
+        account_id = self.table.intern(account_number)
+        self._add(account_id, self._key(account_id, date), row)
+    
+    def contains(self, account_number, date):
+        """Check if an entry already exists for the given account number and date"""
+        account_id = self.table.account_id(account_number)
+        if account_id is None:
+            return False
+        key = self._key(account_id, date)
+        return key in (self.other_entries if isinstance(key, tuple) else self.entries)
+    
+    def _account_value(self, values, account_number):
+        account_id = self.table.account_id(account_number)
+        if account_id is None or account_id >= len(values):
+            return None
+        return values[account_id]
+    
+    def first_row(self, account_number):
+        """First sheet row for the account, or None if it has no rows"""
+        return self._account_value(self.first_rows, account_number)
+    
+    def last_row(self, account_number):
+        """Last sheet row for the account, or None if it has no rows"""
+        return self._account_value(self.last_rows, account_number)
+    
+    def last_date(self, account_number):
+        """Latest reading date on the sheet for the account, or None"""
+        ordinal = self._account_value(self.last_dates, account_number)
+        return datetime.fromordinal(ordinal) if ordinal else None
+
+def get_column_indices(headers):
+    """
+    Find the indices of the important columns from the header row
+    
+    Args:
+        headers (list): Values of the header row
         
-        # Process each account for the specified date
-        new_entries = 0
-        skipped_entries = 0
-        error_entries = 0
+    Returns:
+        dict: Column name to zero-based column index
+    """
+    columns = {}
+    for name, (header, default_idx) in COLUMN_HEADERS.items():
+        columns[name] = headers.index(header) if header in headers else default_idx
+    return columns
+
+def read_sheet_rows(sheet, first_row, last_row, last_col_idx, chunk_size=READ_CHUNK_ROWS):
+    """
+    Read a block of rows from the sheet with as few round-trips as possible
+    
+    Args:
+        sheet (SheetBackend): Sheet to read from
+        first_row (int): First row number to read (1-based)
+        last_row (int): Last row number to read (inclusive)
+        last_col_idx (int): Zero-based index of the last column to read
+        chunk_size (int): Maximum number of rows fetched per block read
         
-        for account_number in account_numbers_list:
-            date_str = start_date_str
-            print(f"\nProcessing account {account_number} for date {date_str}...")
-            
-            # Fetch data from API
-            usage_data = get_electricity_data(account_number, date_str,token)
+    Yields:
+        tuple: (row number, list of cell values) for every row in the block
+    """
+    for chunk_start in range(first_row, last_row + 1, chunk_size):
+        chunk_end = min(chunk_start + chunk_size - 1, last_row)
+        values = sheet.read_block(chunk_start, chunk_end, last_col_idx)
+        for offset, row_data in enumerate(values):
+            yield chunk_start + offset, row_data
+
+def load_sheet_data(sheet, columns, chunk_size=READ_CHUNK_ROWS):
+    """
+    Load every data row of the sheet into a compact table
+    
+    Args:
+        sheet (SheetBackend): Sheet to read from
+        columns (dict): Column indices as returned by get_column_indices
+        chunk_size (int): Maximum number of rows fetched per block read
+        
+    Returns:
+        tuple: (SheetTable of the rows, last row number)
+    """
+    last_row = sheet.last_row()
+    last_col_idx = max(columns.values())
+    
+    table = SheetTable()
+    for i, row_data in read_sheet_rows(sheet, 2, last_row, last_col_idx, chunk_size):
+        # Extract account number from building name
+        building_name = row_data[columns['building']]
+        table.append(i, row_data[columns['date']], building_name, extract_account_number(building_name),
+                     row_data[columns['usage']], row_data[columns['rate']], row_data[columns['cost']],
+                     row_data[columns['sqft']])
+    
+    return table, last_row
+
+class RowWriteBuffer:
+    """
+    Collects new sheet rows and writes them to the workbook in one pass
+    
+    Rows are appended below first_row in the order they are added. Nothing is
+    written until flush(), which copies template formats once per run of
+    rows sharing a template and writes the uploader columns as block assignments.
+    """
+    def __init__(self, sheet, columns, first_row):
+        self.sheet = sheet
+        self.columns = columns
+        self.first_row = first_row
+        self.last_col_idx = max(columns.values())
+        self.rows = []
+    
+    def add(self, template_row, values):
+        """
+        Queue a new row
+        
+        Args:
+            template_row (int): Existing row whose format and formulas are copied
+            values (dict): Column name (as in columns) to cell value
             
-            if not usage_data:
-                print(f"Error: Failed to retrieve data for account {account_number} on {date_str}")
-                error_entries += 1
+        Returns:
+            int: Sheet row number the new row will be written to
+        """
+        self.rows.append((template_row, values))
+        return self.first_row + len(self.rows) - 1
+    
+    def _column_runs(self):
+        """Group the uploader columns into runs of adjacent column indices"""
+        runs = []
+        for name, col_idx in sorted(self.columns.items(), key=lambda item: item[1]):
+            if runs and col_idx == runs[-1][-1][1] + 1:
+                runs[-1].append((name, col_idx))
+            else:
+                runs.append([(name, col_idx)])
+        return runs
+    
+    def _copy_templates(self):
+        """Copy template rows once per run of consecutive rows sharing a template"""
+        run_start = 0
+        for i in range(1, len(self.rows) + 1):
+            if i < len(self.rows) and self.rows[i][0] == self.rows[run_start][0]:
                 continue
-            
+            template_row = self.rows[run_start][0]
+            self.sheet.copy_row_style(template_row, self.first_row + run_start,
+                                      self.first_row + i - 1, self.last_col_idx)
+            run_start = i
+    
+    def flush(self):
+        """
+        Write all queued rows to the sheet
+        
+        Returns:
+            int: Number of rows written
+        """
+        if not self.rows:
+            return 0
+        
+        with self.sheet.workbook.suspend_updates():
+            self._copy_templates()
+            # Only the uploader columns are written so template formulas in
+            # the other columns are kept
+            for run in self._column_runs():
+                block = [[values.get(name) for name, _ in run] for _, values in self.rows]
+                self.sheet.write_block(self.first_row, run[0][1], block)
+        
+        written = len(self.rows)
+        self.first_row += written
+        self.rows = []
+        return written
+
+def build_limiter():
+    """
+    Request limiter for a run
+    
+    Adapts the request rate to the API's responses, starting from the rate
+    the last run ended at, unless ADAPTIVE_RATE=off; then the rate stays
+    fixed at FETCH_RATE.
+    """
+    if adaptive_enabled():
+        return AdaptiveRateLimiter.from_env()
+    return TokenBucket(start_rate())
+
+def fetch_usage_for_accounts(accounts, date_str, token, max_workers=DEFAULT_FETCH_WORKERS, client=None, end_date_str=None, use_cache=True, cancel_event=None, max_pending=None):
+    """
+    Fetch usage data for many accounts concurrently
+    
+    Requests run on a pool of worker threads while the caller consumes the
+    results, so the caller can write to the workbook as data arrives. At most
+    max_pending accounts are fetched or waiting to be consumed at a time; when
+    the caller falls behind the workers stop, rather than piling results up.
+    
+    Args:
+        accounts (list): (commodity, account number) pairs to query
+        date_str (str): Date in YYYY-MM-DD format
+        token (str): Bearer token for the Liberty API
+        max_workers (int): Number of requests in flight at once
+        client (LibertyClient): Client shared by the workers, which applies
+            its rate limiting (shared default client if None)
+        end_date_str (str): End date for backfill mode; every billing period
+            between date_str and end_date_str is fetched in one request per account
+        use_cache (bool): Use the on-disk response cache
+        cancel_event (threading.Event): Once set, no new requests are started;
+            it is set when the client's TokenPool has no token left or the
+            caller stops reading early. Give the client the same event so
+            requests waiting in it stop too
+        max_pending (int): Bound on accounts in flight or waiting, at least
+            max_workers; defaults to DEFAULT_QUEUE_PER_WORKER per worker
+    
+    Yields:
+        tuple: ((commodity, account number), list of extracted usage data
+        oldest first or None on failure), in the same order as accounts, as
+        soon as each account and all accounts before it have been fetched
+    """
+    def fetch(account):
+        commodity, account_number = account
+        if cancel_event and cancel_event.is_set():
+            return None
+        try:
+            if end_date_str:
+                return get_usage_history(account_number, date_str, end_date_str, token, client, use_cache, commodity)
+            usage_data = get_usage_data(account_number, date_str, token, client, use_cache, commodity)
+        except NoLiveTokensError as e:
+            # Every other account would fail the same way, so stop the run
+            with stop_lock:
+                if not cancel_event.is_set():
+                    print(f"\n{e}; stopping. Log in again to fetch the remaining accounts.")
+                    cancel_event.set()
+            return None
+        except RequestCancelledError:
+            return None
+        return [usage_data] if usage_data else None
+    
+    if cancel_event is None:
+        cancel_event = threading.Event()
+    stop_lock = threading.Lock()
+    max_pending = max(max_workers, max_pending or max_workers * DEFAULT_QUEUE_PER_WORKER)
+    remaining = iter(accounts)
+    
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    # Futures in account order; results are handed out from the front
+    pending = deque()
+    
+    def submit_next():
+        account = next(remaining, None)
+        if account is not None:
+            pending.append((account, executor.submit(fetch, account)))
+    
+    try:
+        for _ in range(max_pending):
+            submit_next()
+        while pending:
+            account, future = pending.popleft()
+            result = future.result()
+            # Refill the window before handing the result over, so the
+            # workers keep fetching while the caller writes
+            submit_next()
+            yield account, result
+    finally:
+        if pending:
+            # The caller stopped early: wake the requests still waiting in
+            # the client and drop the ones that haven't started
+            cancel_event.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def merge_journaled(account_numbers, journaled, fetched):
+    """
+    Interleave journaled results with freshly fetched ones, in account order
+    
+    Args:
+        account_numbers (list): All accounts, in processing order
+        journaled (dict): Account number to usage data replayed from the journal
+        fetched: Results of SharedFetch.results for the other accounts, in the same order
+    
+    Yields:
+        tuple: (account number, list of usage data or None, whether it was replayed)
+    """
+    for account_number in account_numbers:
+        if account_number in journaled:
+            yield account_number, journaled[account_number], True
+        else:
+            fetched_account, usages = next(fetched)
+            yield fetched_account, usages, False
+
+def build_client(token, limiter=None, renewer=None, cancel_event=None):
+    """
+    API client for a run
+    
+    Args:
+        token: Bearer token, or a TokenPool
+        limiter: Rate limiter for a single token; build_limiter if None
+        renewer (TokenRenewer): Renews a single token rejected mid-run
+        cancel_event (threading.Event): Stops the client's waiting requests once set
+    
+    Returns:
+        tuple: (client, token to pass with each request, fetch worker count)
+    """
+    # Fetch data from API for all accounts; throughput is set by the shared limiter
+    max_workers = int(os.environ.get('FETCH_WORKERS', DEFAULT_FETCH_WORKERS))
+    if isinstance(token, TokenPool):
+        # Every token has its own budget, so each gets its own set of workers
+        tokens = token
+        max_workers *= len(tokens)
+        print(f"Spreading requests over {len(tokens)} login tokens")
+        print(f"Fetching usage data with {max_workers} workers, starting at {tokens.rate:.2f} requests/s...")
+        return LibertyClient(pool_size=max_workers, tokens=tokens, cancel_event=cancel_event), None, max_workers
+    
+    if limiter is None:
+        limiter = build_limiter()
+    # The client waits on the limiter before every attempt, so retries are
+    # rate limited too and cache hits aren't
+    print(f"Fetching usage data with {max_workers} workers, starting at {limiter.rate:.2f} requests/s...")
+    return LibertyClient(pool_size=max_workers, limiter=limiter, renewer=renewer, cancel_event=cancel_event), token, max_workers
+
+class SharedFetch:
+    """
+    One fetch stream over the accounts of several sheets
+    
+    The accounts every sheet needs fetched are queued in sheet order on one
+    pool of workers and one client, so the workers carry on into the next
+    sheet's accounts while the current sheet is being written. An account
+    on several sheets of the same commodity is fetched once; its result is
+    kept until the last of those sheets has used it.
+    
+    Args:
+        plans (list): SheetPlans, in the order their sheets are written
+        Other arguments as for fetch_usage_for_accounts
+    """
+    def __init__(self, plans, date_str, token, max_workers, client, end_date_str=None, use_cache=True,
+                 cancel_event=None, max_pending=None):
+        accounts = []
+        self.uses = {}
+        for plan in plans:
+            for account_number in plan.to_fetch:
+                key = (plan.commodity, account_number)
+                if key not in self.uses:
+                    accounts.append(key)
+                    self.uses[key] = 0
+                self.uses[key] += 1
+        self.kept = {}
+        self.shared = sum(self.uses.values()) - len(accounts)
+        if self.shared:
+            print(f"{self.shared} accounts appear on more than one sheet and are fetched once")
+            get_metrics().incr("accounts_shared", self.shared)
+        self.stream = fetch_usage_for_accounts(accounts, date_str, token, max_workers, client, end_date_str,
+                                               use_cache, cancel_event, max_pending)
+    
+    def results(self, plan):
+        """
+        Results for a sheet's accounts to fetch; sheets must be read in the order they were planned
+        
+        Yields:
+            tuple: (account number, list of usage data or None), in plan.to_fetch order
+        """
+        for account_number in plan.to_fetch:
+            key = (plan.commodity, account_number)
+            if key in self.kept:
+                usages = self.kept[key]
+            else:
+                _, usages = next(self.stream)
+            self.uses[key] -= 1
+            if self.uses[key]:
+                self.kept[key] = usages
+            else:
+                self.kept.pop(key, None)
+            yield account_number, usages
+    
+    def close(self):
+        """Stop the fetch workers"""
+        self.stream.close()
+
+class SheetPlan:
+    """A loaded sheet and the accounts a run queries for it; see prepare_sheet"""
+    def __init__(self, sheet_name, commodity, sheet, columns, table, index, write_buffer, workbook_name,
+                 account_numbers, not_due, journaled, to_fetch):
+        self.sheet_name = sheet_name
+        self.commodity = commodity
+        self.sheet = sheet
+        self.columns = columns
+        self.table = table
+        self.index = index
+        self.write_buffer = write_buffer
+        self.workbook_name = workbook_name
+        # Accounts to process in order, those replayed from the journal
+        # among them, and the rest that are fetched
+        self.account_numbers = account_numbers
+        self.not_due = not_due
+        self.journaled = journaled
+        self.to_fetch = to_fetch
+
+def prepare_sheet(wb, sheet_name, start_date_str, end_date_str=None, commodity="Electric", journal=None, force=False, history=None):
+    """
+    Load a sheet and work out which of its accounts to query
+    
+    Args:
+        wb (WorkbookBackend): Open workbook
+        sheet_name (str): Sheet holding the account rows
+        start_date_str (str): Date to process in YYYY-MM-DD format
+        end_date_str (str): End date for backfill mode, or None
+        commodity (str): Commodity the sheet's bills are for, see liberty_api.COMMODITIES
+        journal (CheckpointJournal): Accounts it already holds for this sheet
+            and date window are replayed from it instead of fetched
+        force (bool): Query every account, even those whose next bill can't
+            be out yet according to the reading dates on the sheet
+        history (UsageHistory): The sheet's existing rows are imported into
+            it the first time it sees the sheet
+    
+    Returns:
+        SheetPlan: The loaded sheet, ready for apply_sheet
+    """
+    print(f"\nProcessing sheet {sheet_name} ({commodity})...")
+    metrics = get_metrics()
+    sheet = wb.sheet(sheet_name)
+    
+    # Read headers to identify columns
+    headers = sheet.read_block(1, 1, 25)[0]
+    columns = get_column_indices(headers)
+    
+    print("Extracting data and account numbers...")
+    with metrics.timer("load"):
+        table, last_row = load_sheet_data(sheet, columns)
+    account_numbers = set(table.account_numbers)
+    with metrics.timer("index"):
+        index = SheetIndex.from_table(table)
+    metrics.incr("sheet_rows", len(table))
+    
+    workbook_name = os.path.basename(wb.path) if wb.path else None
+    if history and not history.has_sheet(workbook_name, sheet_name):
+        print("Importing the sheet's rows into the usage history (first run only)...")
+        with metrics.timer("history_import"):
+            history.import_table(workbook_name, sheet_name, table)
+    write_buffer = RowWriteBuffer(sheet, columns, last_row + 1)
+    
+    # Get all accounts
+    account_numbers_list = sorted(list(account_numbers))
+    print(f"Found {len(account_numbers_list)} accounts")
+    metrics.incr("accounts", len(account_numbers_list))
+    
+    # Only query accounts whose next bill could be out by the date processed,
+    # or, in backfill mode, that could be missing a bill in the window
+    target_date = datetime.strptime(end_date_str or start_date_str, "%Y-%m-%d")
+    window_start = datetime.strptime(start_date_str, "%Y-%m-%d") if end_date_str else None
+    with metrics.timer("plan"):
+        account_numbers_list, not_due = plan_accounts(account_numbers_list, reading_dates(table), target_date, force,
+                                                      window_start)
+    if not_due:
+        if end_date_str:
+            reason = f"that already have every bill from {start_date_str} to {end_date_str}"
+        else:
+            reason = f"whose next bill isn't due by {target_date:%Y-%m-%d}"
+        print(f"Skipping {len(not_due)} accounts {reason} (set FORCE_FETCH=1 to query them anyway)")
+        metrics.incr("accounts_not_due", len(not_due))
+    print(f"{len(account_numbers_list)} accounts to process")
+    
+    # Accounts finished by an interrupted run are replayed from the journal
+    journaled = journal.completed(sheet_name, start_date_str, end_date_str) if journal else {}
+    journaled = {account: usages for account, usages in journaled.items() if account in account_numbers}
+    if journaled:
+        print(f"Resuming: replaying {len(journaled)} accounts from the checkpoint journal")
+        metrics.incr("journal_replayed", len(journaled))
+    to_fetch = [account for account in account_numbers_list if account not in journaled]
+    
+    return SheetPlan(sheet_name, commodity, sheet, columns, table, index, write_buffer, workbook_name,
+                     account_numbers_list, not_due, journaled, to_fetch)
+
+def apply_sheet(wb, plan, fetched, start_date_str, end_date_str=None, progress=None, cancel_event=None, journal=None, save_schedule=None, history=None):
+    """
+    Queue the new bills of a prepared sheet onto it as their data comes in
+    
+    New rows are written to the sheet before returning; the final save of
+    the workbook is left to the caller.
+    
+    Args:
+        wb (WorkbookBackend): Open workbook
+        plan (SheetPlan): Sheet as returned by prepare_sheet
+        fetched: (account number, usage data) for plan.to_fetch in order,
+            e.g. SharedFetch.results(plan)
+        start_date_str (str): Date to process in YYYY-MM-DD format
+        end_date_str (str): End date for backfill mode, or None
+        progress (callable): Called with a dict after each account: sheet,
+            account, done, total, new, skipped, errors and eta (seconds remaining)
+        cancel_event (threading.Event): Set it to stop after the current
+            account; rows added so far are still written
+        journal (CheckpointJournal): Every completed account is recorded here
+        save_schedule (SaveSchedule): When to save the workbook mid-run
+        history (UsageHistory): Store that receives every fetched reading and new row
+    
+    Returns:
+        dict: Sheet summary with new, skipped, errors, not_due (accounts
+        not queried because no new bill is due) and cancelled
+    """
+    metrics = get_metrics()
+    sheet_name = plan.sheet_name
+    table = plan.table
+    index = plan.index
+    write_buffer = plan.write_buffer
+    workbook_name = plan.workbook_name
+    account_numbers_list = plan.account_numbers
+    
+    # This thread is the only one touching the workbook (COM objects are tied
+    # to the thread that opened them); it writes rows in batches as results
+    # come in while the fetch workers carry on
+    write_batch = int(os.environ.get('WRITE_BATCH_ROWS', DEFAULT_WRITE_BATCH_ROWS))
+    
+    # Process each account for the specified date, in account order
+    new_entries = 0
+    skipped_entries = 0
+    error_entries = 0
+    cancelled = False
+    unsaved_rows = 0
+    started = time.monotonic()
+    
+    # Time spent blocked on the API, as opposed to applying results
+    wait_start = time.perf_counter()
+    results = merge_journaled(account_numbers_list, plan.journaled, fetched)
+    for done, (account_number, usages, replayed) in enumerate(results, 1):
+        metrics.add_time("fetch_wait", time.perf_counter() - wait_start)
+        
+        if cancel_event and cancel_event.is_set():
+            print("\nCancelled; keeping the rows added so far.")
+            cancelled = True
+            break
+        
+        date_str = f"{start_date_str} to {end_date_str}" if end_date_str else start_date_str
+        print(f"\nProcessing account {account_number} for date {date_str}...")
+        
+        if not usages:
+            print(f"Error: Failed to retrieve data for account {account_number} on {date_str}")
+            error_entries += 1
+            usages = []
+        
+        for usage_data in usages:
             # Get the reading date from the API response
             new_date = usage_data['reading_date']
             
             # Check if an entry for this account and date already exists
-            if check_existing_entry(data, account_number, new_date):
+            with metrics.timer("duplicate_check", log=False):
+                exists = index.contains(account_number, new_date)
+            if exists:
                 print(f"Skipping: Entry already exists for account {account_number} on {format_date_for_comparison(new_date)}")
                 skipped_entries += 1
                 continue
             
             # Get building name for this account
-            building_info = account_to_building.get(account_number)
+            building_info = table.building(account_number)
             if not building_info:
                 print(f"Error: Could not find building information for account {account_number}")
                 error_entries += 1
-                continue
+                break
             
             # Extract values from API data
             new_usage = usage_data['usage']
@@ -164,83 +700,323 @@ def main(token):
                 new_rate = usage_data['cost'] / new_usage
             else:
                 new_rate = 0
-                
-            new_cost = usage_data['cost']
-            reading_to_date = usage_data['reading_to']
             
-            # Add the new row to Excel
-            new_row = last_row + 1 + new_entries
+            new_cost = usage_data['cost']
             
             # Copy data format from a previous row for the same account
-            template_row = None
-            for row in data:
-                if row['account_number'] == account_number:
-                    template_row = row['row']
-                    break
+            template_row = index.first_row(account_number)
             
-            if template_row:
-                # Copy row format
-                sheet.range(f"A{template_row}:{chr(65 + max(date_col_idx, building_col_idx, usage_col_idx, rate_col_idx, cost_col_idx, sqft_col_idx))}{template_row}").copy(sheet.range(f"A{new_row}"))
-                
-                # Update with new values
-                sheet.range(f"{chr(65 + date_col_idx)}{new_row}").value = new_date
-                
-                # Add reading_to date to the building name for reference
-                building_info_with_dates = f"{building_info}"
-                sheet.range(f"{chr(65 + building_col_idx)}{new_row}").value = building_info_with_dates
-                
-                sheet.range(f"{chr(65 + usage_col_idx)}{new_row}").value = new_usage
-                sheet.range(f"{chr(65 + rate_col_idx)}{new_row}").value = new_rate
-                sheet.range(f"{chr(65 + cost_col_idx)}{new_row}").value = new_cost
-                
-                # Get SQFT from the template row (it should remain the same for the account)
-                sqft_value = account_to_sqft.get(account_number)
-                if sqft_value:
-                    sheet.range(f"{chr(65 + sqft_col_idx)}{new_row}").value = sqft_value
-                
-                print(f"Added entry for account {account_number} on {format_date_for_comparison(new_date)}")
-                new_entries += 1
+            if template_row is not None:
+                # SQFT stays the same for the account
+                sqft_value = table.sqft(account_number)
                 
-                # Add to data list for duplicate checking
-                data.append({
-                    'row': new_row,
+                # Queue the new row; it is written to Excel with the next batch
+                new_row = write_buffer.add(template_row, {
                     'date': new_date,
-                    'building_name': building_info,
-                    'account_number': account_number,
+                    'building': building_info,
                     'usage': new_usage,
                     'rate': new_rate,
                     'cost': new_cost,
                     'sqft': sqft_value
                 })
+                
+                print(f"Added entry for account {account_number} on {format_date_for_comparison(new_date)}")
+                new_entries += 1
+                unsaved_rows += 1
+                
+                # Add to the table and index for duplicate checking
+                index.add(account_number, new_date, new_row)
+                table.append(new_row, new_date, building_info, account_number,
+                             new_usage, new_rate, new_cost, sqft_value)
+                if history:
+                    history.add_sheet_row(workbook_name, sheet_name, new_row, account_number, new_date,
+                                          building_info, new_usage, new_rate, new_cost, sqft_value)
             else:
                 print(f"Error: Could not find a template row for account {account_number}")
                 error_entries += 1
+                break
+        
+        if history and usages:
+            history.add_readings(usages, plan.commodity)
+        
+        # Failed fetches aren't journaled, so a resumed run retries them
+        if journal and usages and not replayed:
+            journal.record(sheet_name, start_date_str, end_date_str, account_number, usages)
+        
+        # Journaled accounts are safe from a crash; saving bounds how many
+        # rows a resume has to write again
+        if save_schedule and save_schedule.due(unsaved_rows):
+            print(f"\nCheckpoint: saving {unsaved_rows} new rows to the workbook...")
+            with metrics.timer("checkpoint_save"):
+                write_buffer.flush()
+                wb.save()
+                if history:
+                    history.commit()
+            save_schedule.saved()
+            unsaved_rows = 0
+            metrics.incr("checkpoint_saves")
+        elif len(write_buffer.rows) >= write_batch:
+            with metrics.timer("write"):
+                write_buffer.flush()
+                if history:
+                    history.commit()
+        
+        if progress:
+            elapsed = time.monotonic() - started
+            progress({
+                'sheet': sheet_name,
+                'account': account_number,
+                'done': done,
+                'total': len(account_numbers_list),
+                'new': new_entries,
+                'skipped': skipped_entries,
+                'errors': error_entries,
+                'eta': elapsed / done * (len(account_numbers_list) - done)
+            })
+        
+        wait_start = time.perf_counter()
+    
+    # Summary
+    print(f"\n--- {sheet_name}: Processing Complete ---" if not cancelled else f"\n--- {sheet_name}: Processing Cancelled ---")
+    print(f"New entries added: {new_entries}")
+    print(f"Entries skipped (already exist): {skipped_entries}")
+    print(f"Errors: {error_entries}")
+    
+    metrics.incr("new", new_entries)
+    metrics.incr("skipped", skipped_entries)
+    metrics.incr("errors", error_entries)
+    
+    if write_buffer.rows:
+        print(f"\nWriting {len(write_buffer.rows)} new rows to Excel...")
+        with metrics.timer("write"):
+            write_buffer.flush()
+    if history:
+        history.commit()
+    
+    return {
+        'new': new_entries,
+        'skipped': skipped_entries,
+        'errors': error_entries,
+        'not_due': len(plan.not_due),
+        'cancelled': cancelled
+    }
+
+def run_upload(token, excel_file, sheet_names, start_date_str, end_date_str=None, limiter=None, progress=None, cancel_event=None, resume=False, force=False, renewer=None):
+    """
+    Process sheets of a workbook and save it once if any bills were added
+    
+    Every sheet is loaded and planned first; then the accounts of all sheets
+    are fetched over one client and one pool of workers while the sheets are
+    written in order.
+    
+    Args:
+        token: Bearer token for the Liberty API, or a list of tokens of
+            different logins to shard the accounts over
+        excel_file (str): Path to the workbook
+        sheet_names: Sheets holding account rows, processed in order: a dict
+            of sheet name to commodity, or a list of sheet names whose
+            commodity is taken from the name (see sheet_map)
+        start_date_str (str): Date to process in YYYY-MM-DD format
+        end_date_str (str): End date for backfill mode, or None
+        limiter: Rate limiter every request attempt waits on and reports to
+            (TokenBucket, SharedTokenBucket or AdaptiveRateLimiter); see
+            build_limiter if None. Unused with several tokens, which get a
+            limiter each
+        progress (callable): Progress callback, see apply_sheet
+        cancel_event (threading.Event): Set it to stop early; rows added so
+            far are still written and saved. The run also stops this way when
+            every login token has been rejected
+        resume (bool): Replay the checkpoint journal of an interrupted run
+            instead of starting a new one
+        force (bool): Query every account, even those whose next bill can't
+            be out yet according to the reading dates on the sheet
+        renewer (TokenRenewer): Renews a single token if the API rejects it
+            mid-run; the caller closes it
+    
+    Returns:
+        dict: Totals of new, skipped, errors, not_due and cancelled over all sheets,
+        plus the per-sheet summaries under 'sheets' and the run metrics
+        summary under 'metrics'
+    """
+    sheets = normalize_sheets(sheet_names)
+    metrics = start_run(workbook=excel_file)
+    if cancel_event is None:
+        # Lets the fetch stop the run once no login token is left
+        cancel_event = threading.Event()
+    if isinstance(token, (list, tuple)):
+        # A single login doesn't need a pool
+        token = TokenPool(token, build_limiter) if len(set(token)) > 1 else token[0]
+    if isinstance(token, TokenPool):
+        limiter = token
+    elif limiter is None:
+        limiter = build_limiter()
+    try:
+        # Open the Excel file
+        print("\nOpening Excel file...")
+        with metrics.timer("open"):
+            wb = open_workbook(excel_file)
+        journal = None
+        history = None
+        try:
+            # Check every sheet up front so a typo doesn't throw away work on earlier sheets
+            missing = [name for name in sheets if name not in wb.sheet_names()]
+            if missing:
+                raise ValueError(f"Sheet(s) not found in {excel_file}: {', '.join(missing)}")
+            
+            path = journal_path(excel_file)
+            journal = CheckpointJournal(path, resume) if path else None
+            save_schedule = SaveSchedule.from_env()
+            store_path = history_path()
+            history = UsageHistory(store_path) if store_path else None
+            
+            plans = [prepare_sheet(wb, sheet_name, start_date_str, end_date_str, commodity, journal, force, history)
+                     for sheet_name, commodity in sheets.items()]
+            
+            print()
+            client, fetch_token, max_workers = build_client(token, limiter, renewer, cancel_event)
+            if renewer and any(plan.to_fetch for plan in plans):
+                renewer.warm_up()
+            fetch = SharedFetch(plans, start_date_str, fetch_token, max_workers, client, end_date_str,
+                                not os.environ.get('BYPASS_CACHE'), cancel_event,
+                                int(os.environ.get('FETCH_QUEUE', 0)) or None)
             
-            # Sleep to avoid overloading the API
-            time.sleep(5)
-        
-        # Summary
-        print("\n--- Processing Complete ---")
-        print(f"New entries added: {new_entries}")
-        print(f"Entries skipped (already exist): {skipped_entries}")
-        print(f"Errors: {error_entries}")
-        
-        if new_entries > 0:
-            print("\nSaving changes to Excel file...")
-            wb.save()
-            print("Changes saved successfully.")
+            summary = {'new': 0, 'skipped': 0, 'errors': 0, 'not_due': 0, 'cancelled': False, 'sheets': {}}
+            try:
+                for plan in plans:
+                    sheet_summary = apply_sheet(wb, plan, fetch.results(plan), start_date_str, end_date_str,
+                                                progress, cancel_event, journal, save_schedule, history)
+                    summary['sheets'][plan.sheet_name] = sheet_summary
+                    for key in ('new', 'skipped', 'errors', 'not_due'):
+                        summary[key] += sheet_summary[key]
+                    if sheet_summary['cancelled']:
+                        summary['cancelled'] = True
+                        break
+            finally:
+                # Stops the fetch workers if we left early
+                fetch.close()
+                client.close()
+            
+            if summary['new'] > 0:
+                print("\nSaving changes to Excel file...")
+                with metrics.timer("save"):
+                    wb.save()
+                print("Changes saved successfully.")
+            else:
+                print("\nNo changes to save.")
+            
+            if journal:
+                # A cancelled run keeps its journal so it can be resumed
+                if summary['cancelled']:
+                    journal.close()
+                    print(f"Checkpoint journal kept at {path}; run again with --resume to continue.")
+                else:
+                    journal.remove()
+                journal = None
+        finally:
+            if journal:
+                journal.close()
+            if history:
+                history.close()
+            # Close the workbook
+            wb.close()
+    except Exception as e:
+        metrics.finish(error=str(e))
+        raise
+    
+    # The next run starts from the rate this one settled at
+    if isinstance(limiter, (AdaptiveRateLimiter, TokenPool)):
+        limiter.save_state()
+        print(f"Request rate settled at {limiter.rate:.2f} requests/s")
+    summary['fetch_rate'] = limiter.rate
+    
+    summary['metrics'] = metrics.finish(cancelled=summary['cancelled'])
+    latency = summary['metrics']['api_latency']
+    if latency['p95'] is not None:
+        print(f"API requests: {summary['metrics']['api_requests']}, "
+              f"latency p50 {latency['p50']:.3f}s, p95 {latency['p95']:.3f}s")
+    return summary
+
+def main(token, progress=None, cancel_event=None):
+    """
+    Run the uploader with settings from the environment
+    
+    Args:
+        token: Bearer token or list of tokens, or None to use the saved login tokens
+        progress (callable): Progress callback, see apply_sheet
+        cancel_event (threading.Event): Set it to stop the run early
+        
+    Returns:
+        dict: Run summary from run_upload, or None if the run failed
+    """
+    try:
+        print("===== Liberty Bill Uploader =====")
+        
+        # Without a token from the GUI, reuse the ones saved at the last logins
+        if not token:
+            token = load_tokens()
+            if not token:
+                print("Error: No valid saved login token. Log in through the GUI first.")
+                return None
+            print(f"Using {len(token)} saved login token(s)")
+        
+        # Get the date from environment variable or prompt user if not provided
+        start_date_str = os.environ.get('SELECTED_DATE')
+        if not start_date_str:
+            while True:
+                start_date_str = input("Enter date to process (YYYY-MM-DD): ")
+                try:
+                    start_date = datetime.strptime(start_date_str, "%Y-%m-%d")
+                    break
+                except ValueError:
+                    print("Invalid date format. Please use YYYY-MM-DD.")
         else:
-            print("\nNo changes to save.")
+            try:
+                start_date = datetime.strptime(start_date_str, "%Y-%m-%d")
+            except ValueError:
+                print(f"Invalid date format: {start_date_str}. Using current date.")
+                start_date = datetime.now()
+                start_date_str = start_date.strftime("%Y-%m-%d")
+        
+        # An end date switches to backfill mode: every billing period in the window is added
+        end_date_str = os.environ.get('END_DATE')
+        if end_date_str:
+            try:
+                end_date = datetime.strptime(end_date_str, "%Y-%m-%d")
+            except ValueError:
+                print(f"Invalid end date format: {end_date_str}. Processing {start_date_str} only.")
+                end_date_str = None
+            else:
+                if end_date < start_date:
+                    print(f"End date {end_date_str} is before {start_date_str}. Processing {start_date_str} only.")
+                    end_date_str = None
+                else:
+                    print(f"Backfill mode: fetching billing periods from {start_date_str} to {end_date_str}")
         
-        # Close the workbook
-        wb.close()
+        excel_file = os.environ.get('EXCEL_FILE', "MWTC UTILITY BILLS - DASHBOARD.xlsm")
+        # SHEET_MAP names a JSON file mapping each sheet to its commodity
+        sheets = load_sheet_map()
+        # RESUME=1 continues an interrupted run from its checkpoint journal
+        resume = bool(os.environ.get('RESUME'))
+        # FORCE_FETCH=1 queries every account, even those with no bill due yet
+        force = bool(os.environ.get('FORCE_FETCH'))
+        # A single login's token is renewed from its browser profile if it expires mid-run
+        single_token = isinstance(token, str) or len(set(token)) == 1
+        renewer = TokenRenewer.from_env() if single_token else None
+        try:
+            return run_upload(token, excel_file, sheets, start_date_str, end_date_str,
+                              progress=progress, cancel_event=cancel_event, resume=resume, force=force,
+                              renewer=renewer)
+        finally:
+            if renewer:
+                renewer.close()
         
     except Exception as e:
         print(f"Error: {e}")
-        try:
-            wb.close()
-        except:
-            pass
+        return None
 
 if __name__ == "__main__":
+    if "--resume" in sys.argv[1:]:
+        os.environ['RESUME'] = "1"
+    if "--force" in sys.argv[1:]:
+        os.environ['FORCE_FETCH'] = "1"
     main(None)  # Pass None as token when running standalone 
\ No newline at end of file
@@ -0,0 +1,131 @@
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from collections import Counter
+from datetime import datetime
+from unittest import mock
+
+import openpyxl
+
+from benchmark import generate_workbook
+from checkpoint import CheckpointJournal
+from fake_liberty_server import FakeLibertyServer
+from simplified_uploader import run_upload
+
+SHEET = "COLEVILLE ELECTRICITY"
+
+def usage(account_number, day):
+    return {"account_number": account_number, "meter_number": "M1", "reading_date": datetime(2025, 6, day),
+            "reading_from": datetime(2025, 5, day), "reading_to": datetime(2025, 6, day),
+            "usage": 100.0, "cost": 12.5, "uom": "KWH"}
+
+class CheckpointJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, "wb.xlsx.journal.jsonl")
+
+    def test_replays_entries_with_their_dates(self):
+        journal = CheckpointJournal(self.path)
+        journal.record(SHEET, "2025-06-30", None, "1", [usage("1", 15)])
+        journal.close()
+
+        resumed = CheckpointJournal(self.path, resume=True)
+        resumed.close()
+        self.assertEqual(resumed.completed(SHEET, "2025-06-30", None), {"1": [usage("1", 15)]})
+
+    def test_skips_a_line_cut_short_by_a_crash(self):
+        journal = CheckpointJournal(self.path)
+        journal.record(SHEET, "2025-06-30", None, "1", [usage("1", 15)])
+        journal.record(SHEET, "2025-06-30", None, "2", [usage("2", 16)])
+        journal.close()
+        with open(self.path, 'a') as f:
+            f.write('{"sheet": "COLEVILLE ELECTRICITY", "start": "2025-06-30", "end": null, "account": "3", "usa')
+
+        resumed = CheckpointJournal(self.path, resume=True)
+        resumed.close()
+        self.assertEqual(sorted(resumed.completed(SHEET, "2025-06-30", None)), ["1", "2"])
+
+    def test_replays_only_the_same_sheet_and_window(self):
+        journal = CheckpointJournal(self.path)
+        journal.record(SHEET, "2025-06-30", None, "1", [usage("1", 15)])
+        journal.record("COLEVILLE WATER", "2025-06-30", None, "2", [])
+        journal.record(SHEET, "2025-05-31", None, "3", [])
+        journal.record(SHEET, "2025-01-01", "2025-06-30", "4", [])
+        journal.close()
+
+        resumed = CheckpointJournal(self.path, resume=True)
+        resumed.close()
+        self.assertEqual(list(resumed.completed(SHEET, "2025-06-30", None)), ["1"])
+        self.assertEqual(list(resumed.completed(SHEET, "2025-01-01", "2025-06-30")), ["4"])
+        self.assertEqual(resumed.completed(SHEET, "2025-07-31", None), {})
+
+    def test_new_run_starts_afresh(self):
+        journal = CheckpointJournal(self.path)
+        journal.record(SHEET, "2025-06-30", None, "1", [])
+        journal.close()
+
+        CheckpointJournal(self.path).close()
+
+        resumed = CheckpointJournal(self.path, resume=True)
+        resumed.close()
+        self.assertEqual(resumed.completed(SHEET, "2025-06-30", None), {})
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        env = {
+            "WORKBOOK_ENGINE": "openpyxl",
+            "WORKBOOK_BACKUP": "off",
+            "USAGE_CACHE": "off",
+            "USAGE_HISTORY": "off",
+            "METRICS_LOG": "off",
+            "RATE_STATE": os.path.join(self.dir.name, "rate.json"),
+            "TOKEN_CACHE": os.path.join(self.dir.name, "token.json"),
+            "FETCH_RATE": "100",
+            "CHECKPOINT_ROWS": "5",
+        }
+        patcher = mock.patch.dict(os.environ, env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.environ.pop("CHECKPOINT_JOURNAL", None)
+
+    def rows(self, path):
+        sheet = openpyxl.load_workbook(path)[SHEET]
+        return [(row[3], row[0]) for row in sheet.iter_rows(min_row=2, max_col=4, values_only=True)]
+
+    def test_resume_after_crash_adds_no_duplicates(self):
+        path = os.path.join(self.dir.name, "wb.xlsx")
+        generate_workbook(path, 30, 2)
+        original_rows = len(self.rows(path))
+
+        def crash(info):
+            if info['done'] == 17:
+                raise RuntimeError("simulated crash")
+
+        with FakeLibertyServer(latency=0) as server, \
+                mock.patch.dict(os.environ, {"LIBERTY_API_URL": server.url}), \
+                contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(RuntimeError):
+                run_upload("Bearer x", path, [SHEET], "2025-06-30", progress=crash, force=True)
+            self.assertTrue(os.path.exists(path + ".journal.jsonl"))
+            before = server.counts["requests"]
+
+            summary = run_upload("Bearer x", path, [SHEET], "2025-06-30", resume=True, force=True)
+            resumed_requests = server.counts["requests"] - before
+
+        rows = self.rows(path)
+        duplicates = [key for key, count in Counter(rows).items() if count > 1]
+        self.assertEqual(duplicates, [])
+        # Every account gets its June bill exactly once
+        self.assertEqual(len(rows), original_rows + 30)
+        # Journaled accounts aren't fetched again
+        self.assertLess(resumed_requests, 30)
+        self.assertEqual(summary['errors'], 0)
+        self.assertFalse(os.path.exists(path + ".journal.jsonl"))
+
+if __name__ == "__main__":
+    unittest.main()
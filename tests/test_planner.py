@@ -0,0 +1,57 @@
+import unittest
+from datetime import datetime
+
+from planner import plan_accounts
+
+def monthly(year, months, day=15):
+    return [datetime(year, month, day) for month in months]
+
+class PlanAccountsTest(unittest.TestCase):
+    def test_skips_account_with_current_bill(self):
+        dates = {"1": monthly(2026, range(1, 10))}
+        to_query, not_due = plan_accounts(["1"], dates, datetime(2026, 9, 20))
+        self.assertEqual(to_query, [])
+        self.assertIn("1", not_due)
+
+    def test_queries_account_whose_bill_is_due(self):
+        dates = {"1": monthly(2026, range(1, 10))}
+        to_query, _ = plan_accounts(["1"], dates, datetime(2026, 10, 20))
+        self.assertEqual(to_query, ["1"])
+
+    def test_target_before_latest_reading(self):
+        # Only Jul-Sep are on the sheet, so the bill read in March is missing
+        dates = {"1": monthly(2026, [7, 8, 9])}
+        to_query, not_due = plan_accounts(["1"], dates, datetime(2026, 3, 20))
+        self.assertEqual(to_query, ["1"])
+        self.assertEqual(not_due, {})
+
+    def test_target_before_latest_reading_with_bill_present(self):
+        dates = {"1": monthly(2026, range(1, 10))}
+        to_query, not_due = plan_accounts(["1"], dates, datetime(2026, 3, 20))
+        self.assertEqual(to_query, [])
+        self.assertIn("1", not_due)
+
+    def test_backfill_over_gap(self):
+        # April and May are missing from the window
+        dates = {"1": monthly(2026, [1, 2, 3, 6, 7, 8, 9])}
+        to_query, _ = plan_accounts(["1"], dates, datetime(2026, 9, 20), start_date=datetime(2026, 1, 1))
+        self.assertEqual(to_query, ["1"])
+
+    def test_backfill_before_history_starts(self):
+        dates = {"1": monthly(2026, [7, 8, 9])}
+        to_query, _ = plan_accounts(["1"], dates, datetime(2026, 10, 1), start_date=datetime(2026, 1, 1))
+        self.assertEqual(to_query, ["1"])
+
+    def test_backfill_complete_window(self):
+        dates = {"1": monthly(2025, range(1, 13)) + monthly(2026, range(1, 10))}
+        to_query, not_due = plan_accounts(["1"], dates, datetime(2026, 9, 20), start_date=datetime(2026, 1, 1))
+        self.assertEqual(to_query, [])
+        self.assertIn("1", not_due)
+
+    def test_force_and_unknown_accounts(self):
+        dates = {"1": monthly(2026, range(1, 10))}
+        self.assertEqual(plan_accounts(["1", "2"], dates, datetime(2026, 9, 20), force=True)[0], ["1", "2"])
+        self.assertEqual(plan_accounts(["1", "2"], dates, datetime(2026, 9, 20))[0], ["2"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,26 @@
+import unittest
+
+from rate_limiter import AdaptiveRateLimiter, TokenBucket
+
+def make_limiter():
+    return AdaptiveRateLimiter(TokenBucket(2.0), min_rate=0.5, max_rate=10.0, cooldown=0)
+
+class AdaptiveRateLimiterTest(unittest.TestCase):
+    def test_fast_success_raises_rate(self):
+        limiter = make_limiter()
+        limiter.record(200, 0.1)
+        self.assertGreater(limiter.rate, 2.0)
+
+    def test_client_errors_leave_rate_alone(self):
+        limiter = make_limiter()
+        for status in (401, 403, 404):
+            limiter.record(status, 0.1)
+        self.assertEqual(limiter.rate, 2.0)
+
+    def test_throttling_lowers_rate(self):
+        limiter = make_limiter()
+        limiter.record(429, 0.1)
+        self.assertLess(limiter.rate, 2.0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from fake_liberty_server import FakeLibertyServer
+from liberty_api import LibertyClient, NoLiveTokensError, fetch_usage
+from rate_limiter import TokenBucket
+from simplified_uploader import fetch_usage_for_accounts
+from token_pool import TokenPool
+
+TOKENS = ["Bearer a", "Bearer b", "Bearer c"]
+
+def params(account_number):
+    return {"AccountNumber": account_number, "From": "2025-06-01", "To": "2025-06-30", "Uom": "",
+            "Periodicity": "MO", "IsNonAmi": "true"}
+
+def make_pool(tokens=TOKENS):
+    return TokenPool(tokens, lambda: TokenBucket(100))
+
+class TokenPoolTest(unittest.TestCase):
+    def setUp(self):
+        # Retiring a token discards it from the token cache; keep that away from the real one
+        self.cache_dir = tempfile.TemporaryDirectory()
+        patcher = mock.patch.dict(os.environ, {"TOKEN_CACHE": os.path.join(self.cache_dir.name, "token.json")})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.cache_dir.cleanup)
+
+    def test_shards_accounts_stably_over_tokens(self):
+        pool = make_pool()
+        accounts = [str(200000000000 + i) for i in range(60)]
+        picks = {account: pool.pick(account)[0] for account in accounts}
+        self.assertEqual(picks, {account: pool.pick(account)[0] for account in accounts})
+        self.assertEqual(set(picks.values()), set(TOKENS))
+        token, limiter = pool.pick(accounts[0])
+        self.assertIs(limiter, pool.limiters[token])
+
+    def test_avoid_picks_another_token(self):
+        pool = make_pool()
+        token, _ = pool.pick("200000000001")
+        self.assertNotEqual(pool.pick("200000000001", avoid=token)[0], token)
+        single = make_pool(["Bearer a"])
+        self.assertEqual(single.pick("200000000001", avoid="Bearer a")[0], "Bearer a")
+
+    def test_one_revoked_token(self):
+        pool = make_pool()
+        with FakeLibertyServer(latency=0, revoked={"Bearer b"}) as server:
+            client = LibertyClient(base_url=server.url, tokens=pool)
+            try:
+                statuses = [client.get("Electric", params(str(200000000000 + i)), None).status_code
+                            for i in range(30)]
+            finally:
+                client.close()
+        self.assertEqual(statuses, [200] * 30)
+        self.assertEqual(pool.live, ["Bearer a", "Bearer c"])
+
+    def test_throttled_request_fails_over_without_waiting(self):
+        pool = make_pool(["Bearer a", "Bearer b"])
+        # One request per second per token, and a long Retry-After that a retry on the same token would wait out
+        with FakeLibertyServer(latency=0, rate_limit=1, retry_after=30) as server:
+            client = LibertyClient(base_url=server.url, tokens=pool)
+            try:
+                start = time.monotonic()
+                first = client.get("Electric", params("200000000001"), None)
+                second = client.get("Electric", params("200000000001"), None)
+                elapsed = time.monotonic() - start
+            finally:
+                client.close()
+            counts = dict(server.counts)
+        self.assertEqual((first.status_code, second.status_code), (200, 200))
+        self.assertEqual(counts["throttled"], 1)
+        self.assertLess(elapsed, 5)
+
+    def test_all_tokens_revoked(self):
+        pool = make_pool()
+        with FakeLibertyServer(latency=0, revoked=TOKENS) as server:
+            client = LibertyClient(base_url=server.url, tokens=pool)
+            try:
+                with self.assertRaises(NoLiveTokensError):
+                    client.get("Electric", params("200000000001"), None)
+                with self.assertRaises(NoLiveTokensError):
+                    fetch_usage("200000000002", "2025-06-30", None, client, use_cache=False)
+            finally:
+                client.close()
+        self.assertEqual(pool.live, [])
+
+    def test_all_tokens_revoked_stops_the_fetch(self):
+        pool = make_pool()
+        accounts = [("Electric", str(200000000000 + i)) for i in range(50)]
+        cancel_event = threading.Event()
+        with FakeLibertyServer(latency=0.01, revoked=TOKENS) as server:
+            client = LibertyClient(base_url=server.url, tokens=pool, cancel_event=cancel_event)
+            try:
+                results = list(fetch_usage_for_accounts(accounts, "2025-06-30", None, 2, client, use_cache=False,
+                                                        cancel_event=cancel_event, max_pending=4))
+            finally:
+                client.close()
+            requests = server.counts["requests"]
+        self.assertTrue(cancel_event.is_set())
+        self.assertEqual([account for account, _ in results], accounts)
+        self.assertTrue(all(usages is None for _, usages in results))
+        # Only the requests already in flight when the last token went reach the API
+        self.assertLessEqual(requests, 10)
+
+if __name__ == "__main__":
+    unittest.main()
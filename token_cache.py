@@ -0,0 +1,199 @@
+"""
+Token cache for the Liberty Bill Uploader
+Stores the Bearer token captured at login with its expiry, so later runs can
+skip the browser login while the token is still valid. Each login (Chrome
+profile) has its own token file, so several logins can be used at once.
+On Windows the token is encrypted for the current user with DPAPI (pywin32's
+win32crypt); elsewhere the file is readable only by its owner.
+"""
+
+import base64
+import glob
+import json
+import os
+import time
+
+DEFAULT_TOKEN_PATH = os.path.join(os.path.expanduser("~"), ".liberty_bill_uploader", "token.json")
+
+# Chrome profile of the first login; its token lives at the default token path
+DEFAULT_PROFILE = "chromedatabills"
+
+# Tokens within this many seconds of expiry are treated as expired
+EXPIRY_MARGIN = 5 * 60
+
+# Lifetime assumed for tokens that don't carry a JWT exp claim
+FALLBACK_LIFETIME = 30 * 60
+
+def token_path(profile=None):
+    """
+    Token file of a login
+
+    Args:
+        profile (str): Chrome profile directory name of the login; None for the first login
+    """
+    path = os.environ.get('TOKEN_CACHE', DEFAULT_TOKEN_PATH)
+    if profile is None or profile == DEFAULT_PROFILE:
+        return path
+    base, ext = os.path.splitext(path)
+    return f"{base}-{profile}{ext}"
+
+def profile_name(index):
+    """Chrome profile directory of the index-th login: chromedatabills, chromedatabills2, ..."""
+    return DEFAULT_PROFILE if index == 0 else f"{DEFAULT_PROFILE}{index + 1}"
+
+def token_paths():
+    """Token files of every login, the first login first"""
+    base, ext = os.path.splitext(token_path())
+    return [token_path()] + sorted(glob.glob(f"{glob.escape(base)}-*{ext}"))
+
+def decode_jwt_expiry(token):
+    """
+    Read the exp claim from a JWT Bearer token without verifying it
+
+    Args:
+        token (str): Token, with or without the "Bearer " prefix
+
+    Returns:
+        float: Expiry as a Unix timestamp, or None if the token has no readable exp
+    """
+    if not token:
+        return None
+    if token.startswith("Bearer "):
+        token = token[len("Bearer "):]
+    parts = token.split(".")
+    if len(parts) != 3:
+        return None
+    try:
+        payload = parts[1] + "=" * (-len(parts[1]) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+        return float(claims["exp"])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+def protect_token(token):
+    """
+    Fields storing a token in a token file
+
+    Encrypted with DPAPI, so only the current Windows user can read it, where
+    win32crypt is available; as is otherwise.
+    """
+    if os.name != 'nt':
+        return {"token": token}
+    try:
+        import win32crypt
+    except ImportError:
+        print("Warning: pywin32 is not installed; the login token is stored unencrypted.")
+        return {"token": token}
+    blob = win32crypt.CryptProtectData(token.encode(), "Liberty Bill Uploader token", None, None, None, 0)
+    return {"protected_token": base64.b64encode(blob).decode('ascii')}
+
+def unprotect_token(cached):
+    """
+    Token stored in the fields of a token file, see protect_token
+
+    Raises:
+        KeyError: If the fields hold no token
+        ValueError: If an encrypted token can't be decrypted
+    """
+    if "protected_token" not in cached:
+        return cached["token"]
+    try:
+        import win32crypt
+        _, data = win32crypt.CryptUnprotectData(base64.b64decode(cached["protected_token"]), None, None, None, 0)
+    except Exception as e:
+        raise ValueError(f"Could not decrypt the cached token: {e}") from e
+    return data.decode()
+
+def read_token_file(path):
+    """
+    Token and expiry stored in a token file
+
+    Returns:
+        tuple: (token, expires_at)
+
+    Raises:
+        OSError, ValueError, KeyError, TypeError: If the file is missing or unreadable
+    """
+    with open(path, 'r') as f:
+        cached = json.load(f)
+    return unprotect_token(cached), float(cached["expires_at"])
+
+def save_token(token, path=None, profile=None):
+    """
+    Store a token and its expiry on disk, readable only by the current user
+
+    See protect_token for how the token is protected on Windows.
+
+    Args:
+        profile (str): Chrome profile the token was captured with, see token_path
+
+    Returns:
+        float: The expiry stored with the token
+    """
+    path = path or token_path(profile)
+    expires_at = decode_jwt_expiry(token) or time.time() + FALLBACK_LIFETIME
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fields = protect_token(token)
+    # Create the file with owner-only permissions before writing the token to
+    # it; an existing file keeps its old mode when opened, so set it again
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.chmod(path, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(dict(fields, expires_at=expires_at), f)
+    return expires_at
+
+def load_token(path=None, margin=EXPIRY_MARGIN):
+    """
+    Load the cached token if it is still valid for at least margin seconds
+
+    Returns:
+        tuple: (token, expires_at), or (None, None) if there is no usable token
+    """
+    path = path or token_path()
+    try:
+        token, expires_at = read_token_file(path)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None, None
+
+    if expires_at - margin <= time.time():
+        return None, None
+    return token, expires_at
+
+def load_tokens(margin=EXPIRY_MARGIN):
+    """
+    Load the valid cached tokens of every login
+
+    Returns:
+        list: Distinct tokens, the first login's first
+    """
+    tokens = []
+    for path in token_paths():
+        token, _ = load_token(path, margin)
+        if token and token not in tokens:
+            tokens.append(token)
+    return tokens
+
+def discard_token(token=None, path=None):
+    """
+    Delete the cached token, e.g. after the API rejected it
+
+    Args:
+        token (str): Only discard the cache if it holds this token; with no
+            path, every login's token file holding it is discarded
+    """
+    if path is None and token is not None:
+        for login_path in token_paths():
+            discard_token(token, login_path)
+        return
+    path = path or token_path()
+    if token is not None:
+        try:
+            if read_token_file(path)[0] != token:
+                return
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
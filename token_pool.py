@@ -0,0 +1,88 @@
+"""
+Token pool for the Liberty Bill Uploader
+Spreads API requests over the Bearer tokens of several portal logins, each
+with its own rate budget, since the API limits each token separately
+"""
+
+import threading
+import zlib
+
+from metrics import get_metrics
+from rate_limiter import AdaptiveRateLimiter, save_rate
+from token_cache import discard_token
+
+class TokenPool:
+    """
+    Bearer tokens of several logins, each with its own rate limiter
+
+    Accounts are sharded over the live tokens by a stable hash of the account
+    number. A token the API rejects (401/403) is retired for the rest of the
+    run and dropped from the token cache; a request throttled on one token
+    (429) is retried on another.
+
+    Args:
+        tokens (list): Bearer tokens; duplicates are dropped
+        limiter_factory (callable): Returns a new limiter for each token
+    """
+    def __init__(self, tokens, limiter_factory):
+        self.tokens = list(dict.fromkeys(token for token in tokens if token))
+        if not self.tokens:
+            raise ValueError("TokenPool needs at least one token")
+        self.limiters = {token: limiter_factory() for token in self.tokens}
+        self.live = list(self.tokens)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def pick(self, account_number, avoid=None):
+        """
+        Token and limiter to send a request for an account with
+
+        Args:
+            avoid (str): Token to pass over if another one is live, e.g. one
+                that was just throttled
+
+        Returns:
+            tuple: (token, limiter), or (None, None) if every token was retired
+        """
+        with self.lock:
+            if not self.live:
+                return None, None
+            shard = zlib.crc32(str(account_number).encode()) % len(self.live)
+            token = self.live[shard]
+            if token == avoid and len(self.live) > 1:
+                token = self.live[(shard + 1) % len(self.live)]
+        return token, self.limiters[token]
+
+    def has_alternative(self, token):
+        """Check whether a live token other than this one is left"""
+        with self.lock:
+            return any(live != token for live in self.live)
+
+    def retire(self, token):
+        """Stop using a token the API rejected"""
+        with self.lock:
+            if token not in self.live:
+                return
+            self.live.remove(token)
+            remaining = len(self.live)
+        discard_token(token)
+        get_metrics().incr("tokens_retired")
+        print(f"A login token was rejected; continuing with {remaining} other token(s)")
+
+    @property
+    def rate(self):
+        """Combined request rate of the live tokens"""
+        with self.lock:
+            return sum(self.limiters[token].rate for token in self.live)
+
+    def save_state(self):
+        """Save the average per-token rate as the starting point of the next run"""
+        rates = [limiter.rate for limiter in self.limiters.values()
+                 if isinstance(limiter, AdaptiveRateLimiter)]
+        if rates:
+            try:
+                save_rate(sum(rates) / len(rates))
+            except OSError as e:
+                print(f"Warning: Could not save the request rate: {e}")
@@ -0,0 +1,183 @@
+"""
+Mid-run token renewal for the Liberty Bill Uploader
+Keeps a headless browser on the login's Chrome profile ready, so when the
+Bearer token expires partway through a run a fresh one can be captured from
+the portal without a manual login
+"""
+
+import os
+import threading
+import time
+
+from metrics import get_metrics
+from token_cache import DEFAULT_PROFILE, save_token
+
+PORTAL_URL = "https://myaccount.libertyenergyandwater.com/portal/#/login?LUCA"
+
+# Seconds to wait for the portal to send a request carrying a new token
+DEFAULT_RENEW_TIMEOUT = 60
+
+def renewal_enabled():
+    """Token renewal is on unless TOKEN_RENEWAL=off"""
+    return os.environ.get('TOKEN_RENEWAL', 'on').lower() not in ("off", "0", "false")
+
+class BrowserTokenSource:
+    """
+    Headless seleniumbase session on a login's Chrome profile
+
+    The profile keeps the portal session from the last interactive login, so
+    reloading the portal makes it call the API with a current token, which is
+    read from the CDP performance log the same way the login does.
+
+    Args:
+        profile (str): Chrome data directory of the login
+        timeout (float): Seconds to wait for a new token
+    """
+    def __init__(self, profile=DEFAULT_PROFILE, timeout=DEFAULT_RENEW_TIMEOUT):
+        self.profile = profile
+        self.timeout = timeout
+        self.context = None
+        self.sb = None
+        self.error = None
+        self.started = None
+
+    def warm_up(self):
+        """Start the browser in the background so a renewal doesn't wait for it"""
+        if self.started is None:
+            self.started = threading.Thread(target=self._start, daemon=True)
+            self.started.start()
+
+    def _start(self):
+        try:
+            from seleniumbase import SB
+            self.context = SB(uc=True, headless=True, user_data_dir=os.path.abspath(self.profile),
+                              log_cdp_events=True)
+            self.sb = self.context.__enter__()
+        except Exception as e:
+            self.error = e
+            self.context = None
+
+    def __call__(self, stale_token):
+        """
+        Capture a token other than stale_token from the portal
+
+        Returns:
+            str: The new token, or None if the portal sent none in time
+        """
+        from get_token import extract_token_from_logs
+
+        self.warm_up()
+        self.started.join()
+        if self.sb is None:
+            print(f"Could not start the browser for token renewal: {self.error}")
+            return None
+
+        driver = self.sb.driver
+        # Drop the log entries collected so far, they only hold the old token
+        driver.get_log("performance")
+        self.sb.open(PORTAL_URL)
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            token = extract_token_from_logs(driver.get_log("performance"))
+            if token and token != stale_token:
+                return token
+            time.sleep(1)
+        return None
+
+    def close(self):
+        if self.started is not None:
+            self.started.join()
+        if self.context is not None:
+            try:
+                self.context.__exit__(None, None, None)
+            except Exception as e:
+                print(f"Warning: Could not close the token renewal browser: {e}")
+            self.context = None
+            self.sb = None
+
+class TokenRenewer:
+    """
+    Replaces a rejected Bearer token while a run is going
+
+    While a renewal is in progress every request waits in current(), so the
+    fetch queue pauses instead of burning through its accounts with a dead
+    token. Requests rejected at the same time all get the one new token. If
+    a renewal fails, no further one is attempted and the client stops the
+    run (see LibertyClient.get).
+
+    Args:
+        profile (str): Chrome profile of the login; the new token is saved for it
+        source (callable): Takes the stale token and returns a new one or
+            None; a BrowserTokenSource on the profile if None
+    """
+    def __init__(self, profile=DEFAULT_PROFILE, source=None):
+        self.profile = profile
+        self.source = source or BrowserTokenSource(
+            profile, float(os.environ.get('TOKEN_RENEW_TIMEOUT', DEFAULT_RENEW_TIMEOUT)))
+        self.token = None
+        self.failed = False
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.ready.set()
+
+    @classmethod
+    def from_env(cls, profile=DEFAULT_PROFILE):
+        """Renewer for the profile, or None if TOKEN_RENEWAL=off"""
+        return cls(profile) if renewal_enabled() else None
+
+    def warm_up(self):
+        """Get the token source ready ahead of the first renewal"""
+        warm_up = getattr(self.source, "warm_up", None)
+        if warm_up:
+            warm_up()
+
+    def current(self, token, cancel_event=None):
+        """
+        Token to send a request with: the latest renewed one, else token
+
+        Waits out a renewal in progress, unless cancel_event is set first.
+        """
+        if cancel_event is None:
+            self.ready.wait()
+        else:
+            while not self.ready.wait(0.5) and not cancel_event.is_set():
+                pass
+        return self.token or token
+
+    def renew(self, stale_token):
+        """
+        Get a token to replace one the API rejected
+
+        Returns:
+            str: The new token, or None if it couldn't be renewed
+        """
+        with self.lock:
+            if self.token and self.token != stale_token:
+                # Another request already renewed it
+                return self.token
+            if self.failed:
+                return None
+            print("Login token was rejected; renewing it...")
+            self.ready.clear()
+            try:
+                token = self.source(stale_token)
+            except Exception as e:
+                print(f"Token renewal failed: {e}")
+                token = None
+            finally:
+                self.ready.set()
+
+            if not token or token == stale_token:
+                self.failed = True
+                print("Could not renew the login token.")
+                return None
+            self.token = token
+        save_token(token, profile=self.profile)
+        get_metrics().incr("token_renewals")
+        print("Login token renewed; continuing.")
+        return token
+
+    def close(self):
+        close = getattr(self.source, "close", None)
+        if close:
+            close()
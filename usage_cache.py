@@ -0,0 +1,137 @@
+"""
+On-disk cache for Liberty Usage API responses
+Keeps raw API responses in SQLite so reruns don't refetch bills we already have
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = "usage_cache.sqlite"
+
+# Responses that may still change (a newer bill for the window may not be
+# posted yet) only live this long; see liberty_api.is_final_response
+DEFAULT_TTL = 6 * 60 * 60
+
+DEFAULT_MAX_ENTRIES = 50000
+
+class UsageCache:
+    """
+    SQLite-backed response cache keyed by endpoint, account, date window and periodicity
+
+    Entries with an expiry are dropped once they are older than their TTL, and
+    the least recently used entries are evicted when the cache grows beyond
+    max_entries. Safe to share between fetch worker threads, and between
+    processes using the same file.
+    """
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # Batch worker processes share the file; wait for each other's writes
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                endpoint TEXT NOT NULL,
+                account_number TEXT NOT NULL,
+                date_from TEXT NOT NULL,
+                date_to TEXT NOT NULL,
+                periodicity TEXT NOT NULL,
+                response TEXT NOT NULL,
+                expires_at REAL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (endpoint, account_number, date_from, date_to, periodicity)
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.conn.commit()
+
+    def get(self, endpoint, account_number, date_from, date_to, periodicity):
+        """
+        Look up a cached response
+
+        Returns:
+            dict: The cached API response, or None on a miss or expired entry
+        """
+        key = (endpoint, account_number, date_from, date_to, periodicity)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT response, expires_at FROM responses WHERE endpoint = ? AND account_number = ? "
+                "AND date_from = ? AND date_to = ? AND periodicity = ?", key).fetchone()
+            if row is None:
+                return None
+            response, expires_at = row
+            if expires_at is not None and expires_at < now:
+                self.conn.execute(
+                    "DELETE FROM responses WHERE endpoint = ? AND account_number = ? "
+                    "AND date_from = ? AND date_to = ? AND periodicity = ?", key)
+                self.conn.commit()
+                return None
+            self.conn.execute(
+                "UPDATE responses SET last_used = ? WHERE endpoint = ? AND account_number = ? "
+                "AND date_from = ? AND date_to = ? AND periodicity = ?", (now,) + key)
+            self.conn.commit()
+        return json.loads(response)
+
+    def put(self, endpoint, account_number, date_from, date_to, periodicity, response, final=False):
+        """
+        Store an API response
+
+        Args:
+            response (dict): The API response to cache
+            final (bool): Keep the entry until evicted instead of expiring it after the TTL
+        """
+        now = time.time()
+        expires_at = None if final else now + self.ttl
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (endpoint, account_number, date_from, date_to, periodicity,
+                 json.dumps(response), expires_at, now))
+            self._evict(now)
+            self.conn.commit()
+
+    def _evict(self, now):
+        self.conn.execute("DELETE FROM responses WHERE expires_at IS NOT NULL AND expires_at < ?", (now,))
+        count = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM responses WHERE rowid IN "
+                "(SELECT rowid FROM responses ORDER BY last_used LIMIT ?)", (count - self.max_entries,))
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM responses")
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_cache():
+    """
+    Return the shared UsageCache, creating it on first use
+
+    USAGE_CACHE sets the cache file; USAGE_CACHE=off disables caching.
+
+    Returns:
+        UsageCache: The shared cache, or None if caching is disabled
+    """
+    global _default_cache
+    path = os.environ.get('USAGE_CACHE', DEFAULT_CACHE_PATH)
+    if path.lower() in ("off", "0", "false", ""):
+        return None
+    with _default_cache_lock:
+        if _default_cache is None or _default_cache.path != path:
+            if _default_cache is not None:
+                _default_cache.close()
+            _default_cache = UsageCache(path)
+        return _default_cache
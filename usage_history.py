@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+"""
+Local usage history for the Liberty Bill Uploader
+Keeps every reading fetched from the Usage API and every dashboard sheet row
+in an indexed SQLite file, so reports don't need to open the workbook
+
+Examples:
+
+    python usage_history.py import "MWTC UTILITY BILLS - DASHBOARD.xlsm"
+    python usage_history.py summary --from 2024-01-01 --to 2024-12-31
+    python usage_history.py monthly --sheet "COLEVILLE WATER"
+    python usage_history.py readings --account 200000000001 --output readings.csv
+"""
+
+import argparse
+import csv
+import json
+import math
+import os
+import sqlite3
+import sys
+import time
+from datetime import date, datetime
+
+DEFAULT_HISTORY_PATH = "usage_history.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS readings (
+    account_number TEXT NOT NULL,
+    meter_number TEXT NOT NULL,
+    commodity TEXT NOT NULL,
+    reading_date TEXT NOT NULL,
+    reading_from TEXT,
+    reading_to TEXT,
+    usage REAL,
+    cost REAL,
+    uom TEXT,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (account_number, meter_number, commodity, reading_date)
+);
+CREATE INDEX IF NOT EXISTS readings_date ON readings (reading_date);
+
+CREATE TABLE IF NOT EXISTS sheet_rows (
+    workbook TEXT NOT NULL,
+    sheet TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    account_number TEXT,
+    date TEXT,
+    building TEXT,
+    usage REAL,
+    rate REAL,
+    cost REAL,
+    sqft REAL,
+    PRIMARY KEY (workbook, sheet, row)
+);
+CREATE INDEX IF NOT EXISTS sheet_rows_account ON sheet_rows (account_number, date);
+CREATE INDEX IF NOT EXISTS sheet_rows_date ON sheet_rows (date);
+"""
+
+def history_path():
+    """
+    History file from USAGE_HISTORY
+
+    Returns:
+        str: Path of the history database, or None if USAGE_HISTORY=off
+    """
+    path = os.environ.get('USAGE_HISTORY', DEFAULT_HISTORY_PATH)
+    if path.lower() in ("off", "0", "false", ""):
+        return None
+    return path
+
+def date_text(value):
+    """Store dates as YYYY-MM-DD text so they sort and compare as dates"""
+    if isinstance(value, date):
+        return value.strftime("%Y-%m-%d")
+    return str(value) if value is not None else None
+
+def number(value):
+    """Numeric cell value, or None for empty, NaN and text cells"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and not math.isnan(value):
+        return float(value)
+    return None
+
+class UsageHistory:
+    """
+    SQLite store of fetched readings and dashboard sheet rows
+
+    Writes are queued with add_readings / add_sheet_row and written in one
+    transaction by commit(), so the uploader can record rows as it goes
+    without a disk sync per account.
+    """
+    def __init__(self, path=DEFAULT_HISTORY_PATH):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        # WAL lets reports read while a run is writing, and makes commits cheap
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.pending_readings = []
+        self.pending_rows = []
+
+    def add_readings(self, usages, commodity="Electric"):
+        """Queue readings as returned by liberty_api.extract_usage_data"""
+        fetched_at = time.time()
+        for usage in usages:
+            self.pending_readings.append((
+                usage['account_number'], usage['meter_number'], commodity,
+                date_text(usage['reading_date']), date_text(usage['reading_from']),
+                date_text(usage['reading_to']), number(usage['usage']), number(usage['cost']),
+                usage['uom'], fetched_at))
+
+    def add_sheet_row(self, workbook, sheet, row, account_number, date_value, building, usage, rate, cost, sqft):
+        """Queue a dashboard sheet row"""
+        self.pending_rows.append((workbook, sheet, row, account_number, date_text(date_value), building,
+                                  number(usage), number(rate), number(cost), number(sqft)))
+
+    def commit(self):
+        """Write the queued readings and rows"""
+        if not self.pending_readings and not self.pending_rows:
+            return
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO readings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                  self.pending_readings)
+            self.conn.executemany("INSERT OR REPLACE INTO sheet_rows VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                  self.pending_rows)
+        self.pending_readings = []
+        self.pending_rows = []
+
+    def has_sheet(self, workbook, sheet):
+        """Check whether a sheet's rows have been imported"""
+        return self.conn.execute("SELECT 1 FROM sheet_rows WHERE workbook = ? AND sheet = ? LIMIT 1",
+                                 (workbook, sheet)).fetchone() is not None
+
+    def import_table(self, workbook, sheet, table):
+        """
+        Replace the stored rows of a sheet with the rows of a SheetTable
+
+        Returns:
+            int: Number of rows imported
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM sheet_rows WHERE workbook = ? AND sheet = ?", (workbook, sheet))
+        for record in table.records():
+            self.add_sheet_row(workbook, sheet, record['row'], record['account_number'], record['date'],
+                               record['building_name'], record['usage'], record['rate'], record['cost'],
+                               record['sqft'])
+        self.commit()
+        return len(table)
+
+    def _select(self, sql, filters, order_by, conditions=()):
+        """Run a query with the filters whose value isn't None, plus fixed conditions"""
+        clauses = list(conditions) + [clause for clause, value in filters if value is not None]
+        params = [value for _, value in filters if value is not None]
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        return [dict(row) for row in self.conn.execute(f"{sql} {order_by}", params)]
+
+    def readings(self, account_number=None, start=None, end=None, commodity=None):
+        """
+        Fetched readings, optionally filtered by account, reading date range and commodity
+
+        Args:
+            start, end (str): Inclusive YYYY-MM-DD bounds on the reading date
+
+        Returns:
+            list: One dict per reading, by account and date
+        """
+        return self._select("SELECT * FROM readings", [
+            ("account_number = ?", account_number),
+            ("reading_date >= ?", start),
+            ("reading_date <= ?", end),
+            ("commodity = ?", commodity),
+        ], "ORDER BY account_number, reading_date")
+
+    def sheet_rows(self, workbook=None, sheet=None, account_number=None, start=None, end=None):
+        """
+        Dashboard sheet rows, optionally filtered by workbook, sheet, account and date range
+
+        Returns:
+            list: One dict per row, by workbook, sheet and row number
+        """
+        return self._select("SELECT * FROM sheet_rows", [
+            ("workbook = ?", workbook),
+            ("sheet = ?", sheet),
+            ("account_number = ?", account_number),
+            ("date >= ?", start),
+            ("date <= ?", end),
+        ], "ORDER BY workbook, sheet, row")
+
+    def account_summary(self, start=None, end=None, workbook=None, sheet=None):
+        """
+        Per-account totals of the sheet rows in a date range
+
+        Totals are per sheet, since an account on the sheets of several
+        commodities has usage in different units on each.
+
+        Returns:
+            list: Dicts with workbook, sheet, account_number, bills, usage,
+            cost, rate (cost per unit), sqft and cost_per_sqft
+        """
+        return self._select(
+            "SELECT workbook, sheet, account_number, COUNT(*) AS bills, SUM(usage) AS usage, SUM(cost) AS cost, "
+            "SUM(cost) / NULLIF(SUM(usage), 0) AS rate, MAX(sqft) AS sqft, "
+            "SUM(cost) / NULLIF(MAX(sqft), 0) AS cost_per_sqft FROM sheet_rows", [
+                ("date >= ?", start),
+                ("date <= ?", end),
+                ("workbook = ?", workbook),
+                ("sheet = ?", sheet),
+            ], "GROUP BY workbook, sheet, account_number ORDER BY workbook, sheet, account_number",
+            ["account_number IS NOT NULL"])
+
+    def monthly_totals(self, start=None, end=None, account_number=None, workbook=None, sheet=None):
+        """
+        Usage and cost of the sheet rows per month, for trends; per sheet, see account_summary
+
+        Returns:
+            list: Dicts with workbook, sheet, month (YYYY-MM), accounts, usage, cost and rate
+        """
+        return self._select(
+            "SELECT workbook, sheet, substr(date, 1, 7) AS month, COUNT(DISTINCT account_number) AS accounts, "
+            "SUM(usage) AS usage, SUM(cost) AS cost, SUM(cost) / NULLIF(SUM(usage), 0) AS rate FROM sheet_rows", [
+                ("account_number = ?", account_number),
+                ("date >= ?", start),
+                ("date <= ?", end),
+                ("workbook = ?", workbook),
+                ("sheet = ?", sheet),
+            ], "GROUP BY workbook, sheet, month ORDER BY workbook, sheet, month",
+            ["account_number IS NOT NULL", "date IS NOT NULL"])
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+def export_rows(rows, path):
+    """Write query results to a .json file, or CSV for any other extension"""
+    if path.lower().endswith(".json"):
+        with open(path, 'w') as f:
+            json.dump(rows, f, indent=2)
+        return
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        if rows:
+            writer.writerow(rows[0].keys())
+            writer.writerows(row.values() for row in rows)
+
+def print_rows(rows):
+    if not rows:
+        print("No rows.")
+        return
+    columns = list(rows[0].keys())
+    cells = [[f"{value:.4f}" if isinstance(value, float) else "" if value is None else str(value)
+              for value in row.values()] for row in rows]
+    widths = [max(len(column), *(len(row[i]) for row in cells)) for i, column in enumerate(columns)]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in cells:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+def import_workbook(history, excel_file, sheet_names=None, engine=None):
+    """
+    Import the rows of a workbook's sheets into the history, replacing earlier imports
+
+    Args:
+        sheet_names (list): Sheets to import; every sheet with account rows if None
+
+    Returns:
+        dict: Sheet name to number of rows imported
+    """
+    from simplified_uploader import get_column_indices, load_sheet_data
+    from workbook_backend import open_workbook
+
+    wb = open_workbook(excel_file, engine, read_only=True)
+    try:
+        imported = {}
+        for sheet_name in sheet_names or wb.sheet_names():
+            sheet = wb.sheet(sheet_name)
+            headers = sheet.read_block(1, 1, 25)[0]
+            table, _ = load_sheet_data(sheet, get_column_indices(headers))
+            if not table.account_numbers and not sheet_names:
+                continue
+            imported[sheet_name] = history.import_table(os.path.basename(excel_file), sheet_name, table)
+        return imported
+    finally:
+        wb.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query and export the local usage history")
+    parser.add_argument("--db", help=f"History database (default: USAGE_HISTORY or {DEFAULT_HISTORY_PATH})")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import", help="Import (or re-import) the rows of a dashboard workbook")
+    import_parser.add_argument("workbook")
+    import_parser.add_argument("--sheets", nargs="+", help="Sheets to import (default: every sheet with accounts)")
+    import_parser.add_argument("--engine", choices=["xlwings", "openpyxl"])
+
+    for name, help_text in (("readings", "Readings fetched from the API"),
+                            ("rows", "Dashboard sheet rows"),
+                            ("summary", "Per-account totals, rate and cost per SQFT"),
+                            ("monthly", "Usage and cost per month")):
+        query_parser = subparsers.add_parser(name, help=help_text)
+        query_parser.add_argument("--from", dest="start", help="First date, YYYY-MM-DD")
+        query_parser.add_argument("--to", dest="end", help="Last date, YYYY-MM-DD")
+        if name != "summary":
+            query_parser.add_argument("--account")
+        if name == "readings":
+            query_parser.add_argument("--commodity", help="Electric, Water or Gas")
+        else:
+            query_parser.add_argument("--workbook", help="Workbook file name, as imported")
+            query_parser.add_argument("--sheet")
+        query_parser.add_argument("--output", help="Export to this .csv or .json file instead of printing")
+    args = parser.parse_args(argv)
+
+    path = args.db or history_path()
+    if not path:
+        print("Error: The usage history is disabled (USAGE_HISTORY=off)")
+        return 2
+    history = UsageHistory(path)
+    try:
+        if args.command == "import":
+            for sheet_name, count in import_workbook(history, args.workbook, args.sheets, args.engine).items():
+                print(f"Imported {count} rows from {sheet_name}")
+            return 0
+
+        for value in (args.start, args.end):
+            if value:
+                datetime.strptime(value, "%Y-%m-%d")
+        if args.command == "readings":
+            rows = history.readings(args.account, args.start, args.end, args.commodity)
+        elif args.command == "rows":
+            rows = history.sheet_rows(args.workbook, args.sheet, args.account, args.start, args.end)
+        elif args.command == "summary":
+            rows = history.account_summary(args.start, args.end, args.workbook, args.sheet)
+        else:
+            rows = history.monthly_totals(args.start, args.end, args.account, args.workbook, args.sheet)
+
+        if args.output:
+            export_rows(rows, args.output)
+            print(f"Exported {len(rows)} rows to {args.output}")
+        else:
+            print_rows(rows)
+        return 0
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 2
+    finally:
+        history.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
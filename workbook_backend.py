@@ -0,0 +1,245 @@
+"""
+Workbook backends for the Liberty Bill Uploader
+The uploader reads and writes sheets through these classes so it can run
+against a live Excel instance (xlwings) or directly on the file (openpyxl)
+"""
+
+import os
+import shutil
+import sys
+from contextlib import contextmanager
+from copy import copy
+
+ENGINES = ("xlwings", "openpyxl")
+
+def default_engine():
+    """xlwings where Excel can be driven, openpyxl everywhere else"""
+    return "xlwings" if sys.platform in ("win32", "darwin") else "openpyxl"
+
+def column_letter(col_idx):
+    """Convert a zero-based column index to its Excel column letter"""
+    return chr(65 + col_idx)
+
+@contextmanager
+def suspend_excel_updates(app):
+    """
+    Turn off screen updating, events and automatic calculation while writing
+
+    The previous settings are restored on exit, even if the write fails.
+    """
+    screen_updating = app.screen_updating
+    enable_events = app.enable_events
+    calculation = app.calculation
+    app.screen_updating = False
+    app.enable_events = False
+    app.calculation = 'manual'
+    try:
+        yield
+    finally:
+        app.calculation = calculation
+        app.enable_events = enable_events
+        app.screen_updating = screen_updating
+
+class WorkbookBackend:
+    """
+    Interface every workbook engine implements
+
+    Rows and columns follow Excel numbering for rows (1-based) and zero-based
+    indices for columns, matching the column indices used by the uploader.
+    Every workbook has a `path` attribute with the file it was opened from.
+    """
+    path = None
+    
+    def sheet(self, name):
+        """Return the SheetBackend for a sheet name"""
+        raise NotImplementedError
+
+    def sheet_names(self):
+        raise NotImplementedError
+
+    @contextmanager
+    def suspend_updates(self):
+        """Context in which bulk writes should happen"""
+        yield
+
+    def save(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+class SheetBackend:
+    """Interface for a single sheet of a WorkbookBackend"""
+    def __init__(self, workbook):
+        self.workbook = workbook
+
+    def last_row(self):
+        """Last used row number"""
+        raise NotImplementedError
+
+    def read_block(self, first_row, last_row, last_col_idx):
+        """Read rows first_row..last_row, columns A..last_col_idx, as a list of row lists"""
+        raise NotImplementedError
+
+    def copy_row_style(self, template_row, dest_first_row, dest_last_row, last_col_idx):
+        """Copy the format and formulas of template_row onto the destination rows"""
+        raise NotImplementedError
+
+    def write_block(self, first_row, first_col_idx, block):
+        """Write a 2D list of values with its top-left cell at (first_row, first_col_idx)"""
+        raise NotImplementedError
+
+    def append_rows(self, rows, first_col_idx=0):
+        """Write a 2D list of values below the last used row"""
+        self.write_block(self.last_row() + 1, first_col_idx, rows)
+
+class XlwingsWorkbook(WorkbookBackend):
+    """Workbook opened in a live Excel instance through xlwings"""
+    def __init__(self, path):
+        import xlwings as xw
+        self.path = path
+        self.book = xw.Book(path)
+
+    def sheet(self, name):
+        return XlwingsSheet(self, self.book.sheets[name])
+
+    def sheet_names(self):
+        return [sheet.name for sheet in self.book.sheets]
+
+    def suspend_updates(self):
+        return suspend_excel_updates(self.book.app)
+
+    def save(self):
+        self.book.save()
+
+    def close(self):
+        self.book.close()
+
+class XlwingsSheet(SheetBackend):
+    def __init__(self, workbook, sheet):
+        super().__init__(workbook)
+        self.sheet = sheet
+
+    def last_row(self):
+        return self.sheet.used_range.last_cell.row
+
+    def read_block(self, first_row, last_row, last_col_idx):
+        # ndim=2 keeps single-row and single-cell reads as a list of rows
+        return self.sheet.range(f"A{first_row}:{column_letter(last_col_idx)}{last_row}").options(ndim=2).value
+
+    def copy_row_style(self, template_row, dest_first_row, dest_last_row, last_col_idx):
+        last_col = column_letter(last_col_idx)
+        # Excel tiles a single source row over a multi-row destination
+        self.sheet.range(f"A{template_row}:{last_col}{template_row}").copy(
+            self.sheet.range(f"A{dest_first_row}:{last_col}{dest_last_row}"))
+
+    def write_block(self, first_row, first_col_idx, block):
+        last_row = first_row + len(block) - 1
+        last_col_idx = first_col_idx + len(block[0]) - 1
+        self.sheet.range(f"{column_letter(first_col_idx)}{first_row}:{column_letter(last_col_idx)}{last_row}").value = block
+
+class OpenpyxlWorkbook(WorkbookBackend):
+    """
+    Workbook edited directly on disk through openpyxl, no Excel needed
+
+    VBA macros in .xlsm/.xltm files are kept, but saving rewrites the whole
+    file and drops the parts openpyxl doesn't model, such as shapes and
+    form-control buttons, slicers and some extensions. So before the first
+    save over the file, the original is copied to backup_path() unless
+    WORKBOOK_BACKUP=off. With read_only=True the sheet is streamed instead
+    of loaded, which is much faster for large sheets but does not allow
+    writes.
+    """
+    def __init__(self, path, read_only=False):
+        import openpyxl
+        self.path = path
+        self.read_only = read_only
+        self.backed_up = False
+        keep_vba = os.path.splitext(path)[1].lower() in (".xlsm", ".xltm")
+        self.book = openpyxl.load_workbook(path, read_only=read_only, keep_vba=keep_vba)
+
+    def sheet(self, name):
+        return OpenpyxlSheet(self, self.book[name])
+
+    def sheet_names(self):
+        return self.book.sheetnames
+
+    def backup_path(self):
+        """Where the original file is kept: <name>.backup<ext> next to it"""
+        base, ext = os.path.splitext(self.path)
+        return f"{base}.backup{ext}"
+
+    def save(self):
+        if self.read_only:
+            raise RuntimeError("Workbook was opened read-only")
+        backup = os.environ.get('WORKBOOK_BACKUP', 'on').lower() not in ("off", "0", "false")
+        if backup and not self.backed_up and os.path.exists(self.path):
+            shutil.copy2(self.path, self.backup_path())
+            print(f"Original workbook backed up to {self.backup_path()}")
+        self.backed_up = True
+        self.book.save(self.path)
+
+    def close(self):
+        self.book.close()
+
+class OpenpyxlSheet(SheetBackend):
+    def __init__(self, workbook, sheet):
+        super().__init__(workbook)
+        self.sheet = sheet
+
+    def last_row(self):
+        return self.sheet.max_row
+
+    def read_block(self, first_row, last_row, last_col_idx):
+        rows = self.sheet.iter_rows(min_row=first_row, max_row=last_row,
+                                    max_col=last_col_idx + 1, values_only=True)
+        block = []
+        for row in rows:
+            row = list(row)
+            # Read-only sheets can return short rows when trailing cells are empty
+            row.extend([None] * (last_col_idx + 1 - len(row)))
+            block.append(row)
+        return block
+
+    def copy_row_style(self, template_row, dest_first_row, dest_last_row, last_col_idx):
+        from openpyxl.formula.translate import Translator
+
+        if self.workbook.read_only:
+            raise RuntimeError("Workbook was opened read-only")
+        for col in range(1, last_col_idx + 2):
+            source = self.sheet.cell(row=template_row, column=col)
+            for row in range(dest_first_row, dest_last_row + 1):
+                target = self.sheet.cell(row=row, column=col)
+                if source.has_style:
+                    target._style = copy(source._style)
+                # Like an Excel copy, formulas are carried over with relative references shifted
+                value = source.value
+                if isinstance(value, str) and value.startswith("="):
+                    value = Translator(value, origin=source.coordinate).translate_formula(target.coordinate)
+                target.value = value
+
+    def write_block(self, first_row, first_col_idx, block):
+        if self.workbook.read_only:
+            raise RuntimeError("Workbook was opened read-only")
+        for row_offset, values in enumerate(block):
+            for col_offset, value in enumerate(values):
+                self.sheet.cell(row=first_row + row_offset, column=first_col_idx + col_offset + 1, value=value)
+
+def open_workbook(path, engine=None, read_only=False):
+    """
+    Open a workbook with the requested engine
+
+    Args:
+        path (str): Path to the workbook
+        engine (str): "xlwings" or "openpyxl"; defaults to WORKBOOK_ENGINE or the platform default
+        read_only (bool): Stream the file without allowing writes (openpyxl only)
+
+    Returns:
+        WorkbookBackend: The opened workbook
+    """
+    engine = engine or os.environ.get('WORKBOOK_ENGINE') or default_engine()
+    if engine == "xlwings":
+        return XlwingsWorkbook(path)
+    if engine == "openpyxl":
+        return OpenpyxlWorkbook(path, read_only=read_only)
+    raise ValueError(f"Unknown workbook engine: {engine} (expected one of {', '.join(ENGINES)})")